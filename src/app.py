@@ -1,12 +1,17 @@
+import argparse
+import curses
+import datetime
 import os
 import logging
 
 from .tui import curses_tui, Screen
 from .tui import Canvas, Container, Table, TableColumn, FilterTable, TitledBorder
 from .tui import HorizontalFlow, VerticalFlow, print_full_component, full_components_as_list
-from .model import JillModel, MemMapsSnapshot, PROC_STAT_DESC, SELinuxInfo, ThermalInfo
+from .model import JillModel, ReplayModel, Sampler, SamplingGovernor, SingleProcessDelta, ThreadTreeLine, ProcessFilter, PROC_STAT_DESC
 
-from .util import partition, MEM_UNITS, format_memory
+from .batch import run_batch, batch_columns
+from .util import partition, MEM_UNITS, format_memory, PHASE_TIMINGS
+from .conf import CONF, first_start
 
 LOG_FOLDER = os.path.expanduser('~/log')
 
@@ -18,52 +23,74 @@ else:
 logging.basicConfig(filename=os.path.join(LOG_FOLDER, 'jill.log'),level=logging.DEBUG)
 
 class ViewModel:
-    def __init__(self):
+    def __init__(self, state, process_memory):
+        self.state = state
+        self.process_memory = process_memory
+        self.memory_generation = process_memory.generation
         self.selected_pid = None
+        self.selected_thread_of = None # pid of the process, if a thread is selected
 
 class SELinuxComponent(Table):
-    def __init__(self, selinux_info):
+    def __init__(self, view_model):
         super(SELinuxComponent, self).__init__()
-        self.selinux_info = selinux_info
+        self.view_model = view_model
         self.stretch_x = True
 
     def update_from_model(self):
         self.clear_table()
+        selinux_info = self.view_model.state.selinux_info
         self.set_value(0, 0, "Status")
-        self.set_value(0, 1, self.selinux_info.status)
+        self.set_value(0, 1, selinux_info.status)
         self.set_value(1, 0, "Policy")
-        self.set_value(1, 1, self.selinux_info.policy)
+        self.set_value(1, 1, selinux_info.policy)
         self.set_value(2, 0, "Mode")
-        self.set_value(2, 1, self.selinux_info.mode)
+        self.set_value(2, 1, selinux_info.mode)
         self.set_value(3, 0, "MLS")
-        self.set_value(3, 1, self.selinux_info.mls)
+        self.set_value(3, 1, selinux_info.mls)
  
 class CpuUsageComponent(Table):
-    def __init__(self, jill_model, core_columns):
+    def __init__(self, view_model, core_columns):
         super(CpuUsageComponent, self).__init__()
         self.stretch_x = True
-        self.jill_model = jill_model
+        self.view_model = view_model
         self.core_columns = core_columns
 
     def update_from_model(self):
         self.clear_table()
-        d = self.jill_model.delta
+        d = self.view_model.state.delta
         if d:
             self.set_value(0, 0, "Uptime")
             self.set_value(1, 0, "Total")
-            self.set_value(2, 0, "Per Core")
             self.set_value(0, 1, d.cpu_delta.uptime_str)
             self.set_value(1, 1, ("%d%%" % d.cpu_delta.total_cpu_percentage))
-            lines = partition(d.cpu_delta.cpu_percentages, self.core_columns)
-            for y, cpus_per_line in enumerate(lines, start=2):
-                self.set_value(y, 1, " ".join(("%d%%" % c) for c in cpus_per_line))
+            history = self.view_model.state.cpu_history
+            self.set_value(1, 2, history.sparkline(history.total))
+            # What jill itself takes of it, in percent of one core
+            self.set_value(2, 0, "Jill")
+            self.set_value(2, 1, "%.1f%%" % self.view_model.state.self_usage)
+            cpu_percentages = d.cpu_delta.cpu_percentages
+            if len(cpu_percentages) <= self.core_columns and len(history.cores) == len(cpu_percentages):
+                # Few enough cores for a sparkline each
+                for core, (c, series) in enumerate(zip(cpu_percentages, history.cores)):
+                    self.set_value(core + 3, 0, "Core %d" % core)
+                    self.set_value(core + 3, 1, "%d%%" % c)
+                    self.set_value(core + 3, 2, history.sparkline(series))
+            else:
+                self.set_value(3, 0, "Per Core")
+                lines = partition(cpu_percentages, self.core_columns)
+                for y, cpus_per_line in enumerate(lines, start=3):
+                    self.set_value(y, 1, " ".join(("%d%%" % c) for c in cpus_per_line))
+                # The peak of every core in the history, to spot the busy ones
+                peaks = [history.peak_glyph(series) for series in history.cores]
+                self.set_value(len(lines) + 3, 0, "Peaks")
+                self.set_value(len(lines) + 3, 1, " ".join("".join(p) for p in partition(peaks, self.core_columns)))
 
 
 class MemUsageComponent(Table):
-    def __init__(self, jill_model):
+    def __init__(self, view_model):
         super(MemUsageComponent, self).__init__()
         self.stretch_x = True
-        self.jill_model = jill_model
+        self.view_model = view_model
         self.set_value(0, 0, "Total")
         self.set_value(1, 0, "Free")
         self.set_value(2, 0, "Avail")
@@ -76,20 +103,20 @@ class MemUsageComponent(Table):
             return val
 
     def update_from_model(self):
-        mi = self.jill_model.mem_info_snapshot
+        mi = self.view_model.state.mem_info_snapshot
         self.set_value(0, 1, self._format(mi.values['MemTotal']))
         self.set_value(1, 1, self._format(mi.values['MemFree']))
         self.set_value(2, 1, self._format(mi.values['MemAvailable']))
 
 class BatteryStatusComponent(Table):
-    def __init__(self, model, path):
+    def __init__(self, view_model, path):
         super(BatteryStatusComponent, self).__init__()
         self.stretch_x = True
-        self.model = model
+        self.view_model = view_model
         self.path = path
 
     def update_from_model(self):
-        pi = self.model.power_infos[self.path]
+        pi = self.view_model.state.power_infos[self.path]
         self.clear_table()
         self.set_value(0, 0, "Status")
         self.set_value(0, 1, pi.status)
@@ -100,56 +127,115 @@ class BatteryStatusComponent(Table):
             self.set_value(2, 1, pi.time_remaining_str)
 
 class TemperatureComponent(Table):
-    def __init__(self, model):
+    def __init__(self, view_model):
         super(TemperatureComponent, self).__init__(row_limit=4)
         self.stretch_x = True
-        self.model = model
-        self.can_focus = len(model.thermal_info.thermal_zones) > 4
+        self.view_model = view_model
+        self.can_focus = len(view_model.state.thermal_info.thermal_zones) > 4
 
     def update_from_model(self):
-        for y, z in enumerate(self.model.thermal_info.thermal_zones):
+        for y, z in enumerate(self.view_model.state.thermal_info.thermal_zones):
             self.set_value(y, 0, z.zone_type)
             self.set_value(y, 1, z.zone_temp)
 
+def format_rate(io_rate, index):
+    if io_rate is None:
+        return "-"
+    return format_memory(io_rate[index]) + "/s"
+
+class ProcessRow:
+    """The table cells of a ProcessTreeLine, formatted when they are read"""
+    def __init__(self, line):
+        self.line = line
+
+    def __len__(self):
+        return 7
+
+    def __getitem__(self, column):
+        if column == 1:
+            return str(self.line.process_info.pid)
+        if column == 2:
+            ppid = self.line.process_info.ppid
+            return str(ppid) if ppid else ""
+        if column == 0:
+            return self.line.values['UID']
+        if column == 3:
+            return self.line.values['CPU'].rjust(4)
+        if column == 4 or column == 5:
+            return format_rate(self.line.io_rate(), column - 4).rjust(10)
+        if column == 6:
+            return self.line.values['COMMAND']
+        raise IndexError(column)
+
 class ProcessInfoComponent(FilterTable):
-    def __init__(self, model, view_model):
+    def __init__(self, view_model):
         cols = [
             TableColumn('UID', max_width=8),
             TableColumn('PID', max_width=5),
             TableColumn('PPID', max_width=5, visible=False),
             TableColumn('CPU', max_width=4),
+            TableColumn('READ', max_width=10, visible=False),
+            TableColumn('WRITE', max_width=10, visible=False),
             TableColumn('COMMAND', max_width=800)
         ]
         super(ProcessInfoComponent, self).__init__(cols, always_highlight_selection=True)
         self.min_height = 6
         self.stretch_x = True
         self.stretch_y = True
-        self.model = model
         self.view_model = view_model
-        self.process_snapshot = self.model.snapshot.process_snapshot
+        self.process_snapshot = view_model.state.snapshot.process_snapshot
+        self.process_filter = ProcessFilter()
         self.selected_line = 0
         self.selected_pids = []
 
     def update_from_model(self):
         self.remember_selection()
-        self.process_snapshot = self.model.snapshot.process_snapshot
+        state = self.view_model.state
+        self.process_snapshot = state.snapshot.process_snapshot
         self.clear_table()
-        process_delta = self.model.delta.process_delta
-        row = 0
-        for row, l in enumerate(self.process_snapshot.get_process_lines(process_delta, self.search_values())):
-            self.set_value(row, 0, l.values['UID'])
-            self.set_value(row, 1, l.values['PID'])
-            self.set_value(row, 2, str(l.process_info.ppid) if l.process_info.ppid else "")
-            self.set_value(row, 3, l.values['CPU'].rjust(4))
-            self.set_value(row, 4, l.values['COMMAND'])
+        process_delta = state.delta.process_delta
+        lines = self.process_snapshot.get_process_lines(process_delta, self.search_values(), self.process_filter)
+        # Widths from the raw fields, the rows themselves are only formatted
+        # once the table writes them
+        user_snapshot = self.process_snapshot.user_snapshot
+        uid_width = 0
+        pid_width = 0
+        command_width = 0
+        for l in lines:
+            pi = l.process_info
+            uid_width = max(uid_width, len(user_snapshot.username(pi.uid)))
+            pid_width = max(pid_width, len(str(pi.pid)))
+            command_width = max(command_width, len(l.prefix) + len(pi.comm))
+        self.table.set_rows([ProcessRow(l) for l in lines], [uid_width, pid_width, 0, 4, 10, 10, command_width])
 
         self.reselect()
         self.view_model.selected_pid = self.get_selected_pid()
+        self.view_model.selected_thread_of = self.get_selected_thread_of()
 
     def get_selected_pid(self):
         row =  self.table._data[self.table.selected_row_index]
         return row[1]
 
+    def show_io(self, visible):
+        for column in (4, 5):
+            self.table.set_column_visible(column, visible)
+
+    def get_selected_process_pid(self):
+        """pid of the selected process, or of the process of the selected thread"""
+        if len(self.table._data) == 0:
+            return None
+        line = self.table._data[self.table.selected_row_index].line
+        if isinstance(line, ThreadTreeLine):
+            return line.process_info.ppid
+        return line.process_info.pid
+
+    def get_selected_thread_of(self):
+        """pid of the process of the selected thread, None if it's no thread"""
+        if len(self.table._data) == 0:
+            return None
+        line = self.table._data[self.table.selected_row_index].line
+        return line.process_info.ppid if isinstance(line, ThreadTreeLine) else None
+
     def insert_selected_pids(self, index):
         row = self.table._data[index]
         self.selected_pids.insert(0, row[2] if row[2] else "0")
@@ -179,10 +265,9 @@ class ProcessInfoComponent(FilterTable):
         self.table.selected_row_index = sel_row_index
 
 class ProcessDetailsComponent(Table):
-    def __init__(self, model, view_model):
-        super(ProcessDetailsComponent, self).__init__(row_limit=5)
+    def __init__(self, view_model):
+        super(ProcessDetailsComponent, self).__init__(row_limit=6)
         self.stretch_x = True
-        self.model = model
         self.view_model = view_model
 
     def update_from_model(self):
@@ -196,10 +281,33 @@ class ProcessDetailsComponent(Table):
         if not pid:
             self.set_value(0, 0, "n/a")
             return
-        process_info = self.model.snapshot.process_snapshot.process_info_by_pid[pid]
-        process_delta = self.model.delta.process_delta
- 
-        spd = process_delta.get_single_process_delta(pid) 
+        model_state = self.view_model.state
+        process_snapshot = model_state.snapshot.process_snapshot
+        process_delta = model_state.delta.process_delta
+        thread_of = self.view_model.selected_thread_of
+        if thread_of is None:
+            process_info = process_snapshot.get_process_info(pid)
+            owner_info = process_info
+        else:
+            # The thread's own task, memory is shared with its process
+            process_info = process_snapshot.get_thread_info(thread_of, pid)
+            owner_info = process_snapshot.get_process_info(thread_of)
+        if process_info is None or owner_info is None:
+            self.set_value(0, 0, "n/a")
+            return
+
+        if thread_of is None:
+            spd = process_delta.get_single_process_delta(pid)
+            cpu_usage = process_delta.cpu_usage(pid)
+            io_rate = process_delta.io_rate(pid)
+        else:
+            spd = process_delta.get_single_thread_delta(thread_of, pid)
+            cpu_usage = process_delta.thread_cpu_usage(thread_of, pid)
+            # Counted for the whole process
+            io_rate = None
+        if spd is None:
+            # Started since the previous tick
+            spd = SingleProcessDelta(0, 0, 0, 0)
 
         if process_info.state in PROC_STAT_DESC: 
             state = PROC_STAT_DESC[process_info.state] 
@@ -210,83 +318,183 @@ class ProcessDetailsComponent(Table):
         cutime = spd.cutime 
         cstime = spd.cstime 
            
-        mms = MemMapsSnapshot(pid) 
-        mem_net = mms.rw_mem 
+        # Read on a worker thread, shows the last reading meanwhile
+        memory = self.view_model.process_memory.get(owner_info.pid, owner_info.starttime)
         mem_gross = process_info.vsize 
 
         width_col_1 = self.col_widths[1] if len(self.col_widths) > 1 else 5
         self.set_value(0, 0, "Command")
         self.set_value(0, 1, process_info.comm[:width_col_1])
         self.set_value(0, 2, "CPU")
-        self.set_value(0, 3, "%d%% / %s" % (int(process_delta.cpu_usage(pid)), state) )
+        self.set_value(0, 3, "%d%% / %s" % (int(cpu_usage), state) )
         self.set_value(1, 0, "PID")
         self.set_value(1, 1, "{}".format(pid))
         self.set_value(1, 2, "PPID")
         self.set_value(1, 3, "{}".format(process_info.ppid))
+        if process_delta.io_rates is not None:
+            self.set_value(0, 4, "Read")
+            self.set_value(0, 5, format_rate(io_rate, 0) if io_rate else "n/a")
+            self.set_value(1, 4, "Write")
+            self.set_value(1, 5, format_rate(io_rate, 1) if io_rate else "n/a")
         self.set_value(2, 0, "U/S TIME")
         self.set_value(2, 1, "{}/{}".format(utime, stime))
         self.set_value(2, 2, "CU/CS TIME")
         self.set_value(2, 3, "{}/{}".format(cutime, cstime))
-        self.set_value(3, 0, "Mem Net")
-        self.set_value(3, 1, format_memory(mem_net))
+        self.set_value(3, 0, "Mem RSS")
+        self.set_value(3, 1, self._format_memory(memory.rss if memory else None, memory))
         self.set_value(3, 2, "Mem Gross")
         self.set_value(3, 3, format_memory(mem_gross))
-        if self.model.selinux_info():
-            self.set_value(4, 0, "SELinux")
-            self.set_value(4, 1, process_info.selinux_1)
-            self.set_value(4, 2, process_info.selinux_2)
-            self.set_value(4, 3, process_info.selinux_3)
+        if memory is not None and memory.pss is None and memory.writable is not None:
+            self.set_value(4, 0, "Mem Net")
+            self.set_value(4, 1, format_memory(memory.writable))
+        else:
+            self.set_value(4, 0, "Mem PSS")
+            self.set_value(4, 1, self._format_memory(memory.pss if memory else None, memory))
+        self.set_value(4, 2, "Swap")
+        self.set_value(4, 3, self._format_memory(memory.swap if memory else None, memory))
+        if model_state.selinux_info():
+            self.set_value(5, 0, "SELinux")
+            self.set_value(5, 1, process_info.selinux_1)
+            self.set_value(5, 2, process_info.selinux_2)
+            self.set_value(5, 3, process_info.selinux_3)
+
+    @staticmethod
+    def _format_memory(value, memory):
+        if memory is None:
+            return "..."
+        if value is None:
+            return "n/a"
+        return format_memory(value)
+
+class ReplayComponent(Table):
+    def __init__(self, view_model):
+        super(ReplayComponent, self).__init__()
+        self.stretch_x = True
+        self.view_model = view_model
+        self.set_value(0, 0, "Time")
+        self.set_value(1, 0, "Tick")
+        self.set_value(2, 0, "State")
+        self.set_value(3, 0, "Keys")
+        self.set_value(3, 1, "Left/Right step, Home, End play")
+
+    def update_from_model(self):
+        replay = self.view_model.state.replay
+        self.set_value(0, 1, datetime.datetime.fromtimestamp(replay.wall_time).strftime("%Y-%m-%d %H:%M:%S"))
+        self.set_value(1, 1, "{} / {}".format(replay.index + 1, replay.count))
+        self.set_value(2, 1, "playing" if replay.playing else "paused")
+
+class PhaseTimingsComponent(Table):
+    CAPTIONS = ["Phase [ms]", "Runs", "p50", "p90", "p99", "Max"]
+    GOVERNOR_CAPTIONS = ["Governor", "CPU %", "Interval", "Base", "Max", "Budget"]
+
+    def __init__(self, governor):
+        super(PhaseTimingsComponent, self).__init__()
+        self.governor = governor
+        self.update_from_model()
+
+    def update_from_model(self):
+        timings = PHASE_TIMINGS.timings()
+        self.clear_table()
+        for col, caption in enumerate(PhaseTimingsComponent.CAPTIONS):
+            self.set_value(0, col, caption)
+        for row, t in enumerate(timings, 1):
+            self.set_value(row, 0, t.name)
+            self.set_value(row, 1, str(t.count))
+            for col, ns in enumerate([t.p50, t.p90, t.p99, t.max], 2):
+                self.set_value(row, col, "{:.2f}".format(ns / 1e6))
+        if self.governor:
+            self.update_governor(len(timings) + 1)
+
+    def update_governor(self, row):
+        g = self.governor
+        for col, caption in enumerate(PhaseTimingsComponent.GOVERNOR_CAPTIONS):
+            self.set_value(row, col, caption)
+        self.set_value(row + 1, 0, "now")
+        self.set_value(row + 1, 1, "{:.1f}".format(g.usage.percentage))
+        self.set_value(row + 1, 2, "{:.2f}".format(g.interval))
+        self.set_value(row + 1, 3, "{:.2f}".format(g.base_interval))
+        self.set_value(row + 1, 4, "{:.2f}".format(g.max_interval))
+        self.set_value(row + 1, 5, "{:.1f}".format(g.budget))
+        # Latest decision first
+        for r, d in enumerate(reversed(list(g.decisions)), row + 2):
+            self.set_value(r, 0, datetime.datetime.fromtimestamp(d.wall_time).strftime("%H:%M:%S"))
+            self.set_value(r, 1, "{:.1f}".format(d.usage))
+            self.set_value(r, 2, "{:.2f}".format(d.new_interval))
+            # Blank cells, or the overlay shows what is below
+            for col in range(3, len(PhaseTimingsComponent.GOVERNOR_CAPTIONS)):
+                self.set_value(r, col, "")
 
 class MainJillView(VerticalFlow):
-        def __init__(self, model):
+        def __init__(self, view_model):
             super(MainJillView, self).__init__()
 
-            view_model = ViewModel()
+            state = view_model.state
+            ti = state.thermal_info
+            selinux_info = state.selinux_info
 
-            ti = ThermalInfo()
-            selinux_info = model.selinux_info
-
-            top_boxes_count = 2 + len(model.battery_paths) + (1 if ti.thermal_zones else 0) + (1 if selinux_info() else 0)
+            top_boxes_count = 2 + len(state.battery_paths) + (1 if ti.thermal_zones else 0) + (1 if selinux_info() else 0)
+            if state.replay:
+                top_boxes_count += 1
 
             top_line = HorizontalFlow()
 
+            if state.replay:
+                replay = ReplayComponent(view_model)
+                top_line.add(TitledBorder("Replay", replay))
+
             if selinux_info():
-                selinux = SELinuxComponent(selinux_info)
+                selinux = SELinuxComponent(view_model)
                 top_line.add(TitledBorder("SELinux", selinux))
 
-            cpu = CpuUsageComponent(model, 4 if top_boxes_count >=4 else 8)
+            cpu = CpuUsageComponent(view_model, 4 if top_boxes_count >=4 else 8)
             top_line.add(TitledBorder("CPU", cpu))
 
-            mem = MemUsageComponent(model)
+            mem = MemUsageComponent(view_model)
             top_line.add(TitledBorder("Memory", mem))
 
-            for p in model.battery_paths:
-                batt = BatteryStatusComponent(model, p)
+            for p in state.battery_paths:
+                batt = BatteryStatusComponent(view_model, p)
                 top_line.add(TitledBorder(p, batt))
 
             if ti.thermal_zones:
-                temp = TemperatureComponent(model)
+                temp = TemperatureComponent(view_model)
                 top_line.add(TitledBorder("Temperature", temp))
             
             self.add(top_line)
 
-            procInfo = ProcessInfoComponent(model, view_model)
+            procInfo = ProcessInfoComponent(view_model)
+            self.process_info = procInfo
             mid_line = HorizontalFlow()
             mid_line.add(TitledBorder("Processes", procInfo))
             self.add(mid_line)
 
-            procDetails = ProcessDetailsComponent(model, view_model)
+            procDetails = ProcessDetailsComponent(view_model)
             low_line = HorizontalFlow()
             low_line.add(TitledBorder("Process Details", procDetails))
             self.add(low_line)
 
 class JillScreen(Screen):
-    def __init__(self):
+    def __init__(self, model):
         self.rows = 0
         self.cols = 0
-        self.model = JillModel()
-        self.view = MainJillView(self.model)
+        self.model = model
+        interval = CONF.get('sample-interval', 1.0)
+        if isinstance(model, ReplayModel) or not CONF.get('cpu-budget', 5.0):
+            # Replays go at the speed of the recording
+            governor = None
+        else:
+            governor = SamplingGovernor(interval, CONF.get('cpu-budget', 5.0), CONF.get('max-sample-interval', 10.0))
+        self.sampler = Sampler(self.model, interval, governor)
+        self.sampler.start()
+        # The first tick gives us a delta to show
+        self.sampler.first_tick.wait()
+        self.view_model = ViewModel(self.sampler.latest(), self.model.process_memory)
+        self.view = MainJillView(self.view_model)
+        self.view.process_info.show_io(self.model.read_io)
         super(JillScreen, self).__init__(self.view)
+        PHASE_TIMINGS.enabled = CONF.get('phase-timings', False)
+        self.timings = PhaseTimingsComponent(governor)
+        self.timings_view = TitledBorder("Timings F2", self.timings)
 
     def resized(self, rows, cols):
         if self.rows != rows or self.cols != cols:
@@ -294,16 +502,94 @@ class JillScreen(Screen):
             self.cols = cols
             self.view.layout(self.cols - 1, self.rows)
 
+    def toggle_timings(self):
+        if self.overlay:
+            self.overlay = None
+            PHASE_TIMINGS.enabled = CONF.get('phase-timings', False)
+        else:
+            self.overlay = self.timings_view
+            PHASE_TIMINGS.enabled = True
+
+    def handle_key(self, c):
+        if c == curses.KEY_F2:
+            self.toggle_timings()
+        elif c == curses.KEY_F3:
+            PHASE_TIMINGS.log()
+        elif c == curses.KEY_F4:
+            # /proc/<pid>/io is only read while the columns are shown
+            self.model.read_io = not self.model.read_io
+            self.view.process_info.show_io(self.model.read_io)
+        elif c in (10, curses.KEY_ENTER) and self.view.process_info.table.has_focus:
+            # Expands the selected process into its threads, or collapses it again
+            pid = self.view.process_info.get_selected_process_pid()
+            if pid:
+                self.model.toggle_threads(pid)
+        elif self.view_model.state.replay is None:
+            super(JillScreen, self).handle_key(c)
+        elif c == curses.KEY_LEFT:
+            self.model.step(-1)
+        elif c == curses.KEY_RIGHT:
+            self.model.step(1)
+        elif c == curses.KEY_HOME:
+            self.model.step(-len(self.model.recording))
+        elif c == curses.KEY_END:
+            self.model.play()
+        else:
+            super(JillScreen, self).handle_key(c)
+
+    def needs_update(self):
+        if self.sampler.latest() is not self.view_model.state:
+            return True
+        # A memory reading for the details arrived
+        return self.model.process_memory.generation != self.view_model.memory_generation
+
     def time_tick(self, force_layout=False):
-        self.model.time_tick()
+        # Never samples itself, only picks up what the sampler published last
+        self.view_model.state = self.sampler.latest()
+        self.view_model.memory_generation = self.model.process_memory.generation
+        t = PHASE_TIMINGS.start()
         self.view.update_from_model()
+        PHASE_TIMINGS.stop("ui.update_from_model", t)
         if force_layout or not self.view.layout_valid:
+            t = PHASE_TIMINGS.start()
             self.view.layout(self.cols - 1, self.rows)
+            PHASE_TIMINGS.stop("ui.layout", t)
+        if self.overlay:
+            self.timings.update_from_model()
+
+    def close(self):
+        self.sampler.stop()
+        self.model.close()
+        if PHASE_TIMINGS.phases:
+            PHASE_TIMINGS.log()
 
 class JillApp:
     def start(self):
-        with curses_tui(halfdelay=10) as t:
-            js = JillScreen()
+        parser = argparse.ArgumentParser(prog="jill")
+        parser.add_argument("--replay", metavar="FILE", help="step through a recording of the flight recorder")
+        parser.add_argument("--batch", action="store_true", help="no TUI, write records to stdout")
+        parser.add_argument("--format", choices=["json", "csv"], default="json", help="JSON lines or CSV, for --batch")
+        parser.add_argument("--interval", type=float, metavar="SECONDS", help="seconds between ticks, for --batch")
+        parser.add_argument("--count", type=int, default=0, metavar="N", help="stop after N ticks, for --batch")
+        parser.add_argument("--processes", action="store_true", help="a record per process and tick, for --batch")
+        parser.add_argument("--columns", metavar="A,B,...", help="columns of the records, for --batch")
+        args = parser.parse_args()
+        first_start(not args.batch)
+        if args.batch:
+            try:
+                batch_columns(args.columns, args.processes)
+            except ValueError as e:
+                parser.error(str(e))
+            run_batch(args)
+            return
+        if args.replay:
+            model = ReplayModel(args.replay)
+        else:
+            model = JillModel()
+        with curses_tui(halfdelay=2) as t:
+            js = JillScreen(model)
             t.add_screen(js)
-            t.event_loop()
-
+            try:
+                t.event_loop()
+            finally:
+                js.close()
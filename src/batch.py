@@ -0,0 +1,138 @@
+import csv
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+
+from .model import JillModel, ReplayModel, ProcessInfo, tick_schedule
+from .conf import CONF
+
+# jill --batch: the model without curses, one record per tick or one per
+# process per tick, as JSON lines or CSV on stdout. Every stage is a
+# generator, a tick is written while it's turned into records.
+
+def mem_kb(state, key):
+    value = state.mem_info_snapshot.values.get(key)
+    return int(value.split()[0]) if value else None
+
+TICK_COLUMNS = {
+    'time' : lambda t, s: round(t, 3),
+    'uptime' : lambda t, s: s.snapshot.cpu_snapshot.uptime,
+    'cpu' : lambda t, s: round(s.delta.cpu_delta.total_cpu_percentage, 1),
+    'cpu_cores' : lambda t, s: [round(c, 1) for c in s.delta.cpu_delta.cpu_percentages],
+    'mem_total' : lambda t, s: mem_kb(s, 'MemTotal'),
+    'mem_free' : lambda t, s: mem_kb(s, 'MemFree'),
+    'mem_available' : lambda t, s: mem_kb(s, 'MemAvailable'),
+    'processes' : lambda t, s: len(s.snapshot.process_snapshot.table) - 1
+}
+DEFAULT_TICK_COLUMNS = list(TICK_COLUMNS)
+
+PROCESS_COLUMNS = {
+    'time' : lambda t, s, p: round(t, 3),
+    'pid' : lambda t, s, p: p.pid,
+    'ppid' : lambda t, s, p: p.ppid,
+    'uid' : lambda t, s, p: p.uid,
+    'user' : lambda t, s, p: s.snapshot.process_snapshot.user_snapshot.username(p.uid),
+    'state' : lambda t, s, p: p.state,
+    'cpu' : lambda t, s, p: round(s.delta.process_delta.cpu_percentages[p.row], 1),
+    'utime' : lambda t, s, p: p.utime,
+    'stime' : lambda t, s, p: p.stime,
+    'vsize' : lambda t, s, p: p.vsize,
+    'starttime' : lambda t, s, p: p.starttime,
+    'comm' : lambda t, s, p: p.table.metadata[p.row].comm,
+    'command' : lambda t, s, p: p.comm
+}
+DEFAULT_PROCESS_COLUMNS = ['time', 'pid', 'ppid', 'user', 'state', 'cpu', 'vsize', 'command']
+
+def live_states(model, interval, count):
+    """(wall clock time, ModelState) of every tick, forever with count 0"""
+    schedule = tick_schedule(lambda: interval)
+    # The model took its first sample when it was made
+    next(schedule)
+    ticks = 0
+    while not count or ticks < count:
+        next(schedule)
+        model.time_tick()
+        ticks += 1
+        yield time.time(), model.state
+
+def replay_states(model, count):
+    """(recorded time, ModelState) of every recorded tick, as fast as it goes"""
+    ticks = 0
+    while not count or ticks < count:
+        state = model.state
+        yield state.replay.wall_time, state
+        ticks += 1
+        if state.replay.index + 1 >= state.replay.count:
+            return
+        model.step(1)
+
+def tick_records(wall_time, state, columns):
+    yield [TICK_COLUMNS[c](wall_time, state) for c in columns]
+
+def process_records(wall_time, state, columns):
+    # The delta's rows are the rows of its second table, not the snapshot's
+    table = state.delta.process_delta.process_snapshot2.table
+    for row in range(1, len(table)):
+        p = ProcessInfo(table, row)
+        yield [PROCESS_COLUMNS[c](wall_time, state, p) for c in columns]
+
+class JsonLinesOutput:
+    def __init__(self, out, columns):
+        self.out = out
+        self.columns = columns
+
+    def write(self, records):
+        for values in records:
+            self.out.write(json.dumps(dict(zip(self.columns, values))))
+            self.out.write("\n")
+
+class CsvOutput:
+    def __init__(self, out, columns):
+        self.writer = csv.writer(out)
+        self.writer.writerow(columns)
+
+    def write(self, records):
+        for values in records:
+            self.writer.writerow([" ".join(str(v) for v in value) if isinstance(value, list) else value for value in values])
+
+def batch_columns(names, per_process):
+    """The columns asked for, or the defaults. Raises ValueError for unknown ones."""
+    known = PROCESS_COLUMNS if per_process else TICK_COLUMNS
+    if not names:
+        return DEFAULT_PROCESS_COLUMNS if per_process else DEFAULT_TICK_COLUMNS
+    columns = [c.strip() for c in names.split(",") if c.strip()]
+    unknown = [c for c in columns if c not in known]
+    if unknown:
+        raise ValueError("Unknown columns {}, known are {}".format(", ".join(unknown), ", ".join(known)))
+    return columns
+
+def run_batch(args, out=sys.stdout):
+    columns = batch_columns(args.columns, args.processes)
+    interval = args.interval if args.interval is not None else CONF.get('sample-interval', 1.0)
+    if args.replay:
+        model = ReplayModel(args.replay)
+        states = replay_states(model, args.count)
+    else:
+        model = JillModel(sample_interval=interval)
+        states = live_states(model, interval, args.count)
+    records = process_records if args.processes else tick_records
+    output = CsvOutput(out, columns) if args.format == 'csv' else JsonLinesOutput(out, columns)
+    try:
+        for wall_time, state in states:
+            output.write(records(wall_time, state, columns))
+            out.flush()
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        # The reader is gone (jill --batch | head), nothing left to do
+        logging.info("Batch output closed by the reader")
+        # Or the final flush at exit complains once more
+        os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+    finally:
+        try:
+            model.close()
+        except Exception:
+            logging.error(traceback.format_exc())
@@ -1,5 +1,6 @@
 import json
 import os
+import sys
 
 GRAPH_CHAR_UTF8 = {}
 GRAPH_CHAR_UTF8['degree'] = '°C'
@@ -11,6 +12,7 @@ GRAPH_CHAR_UTF8['corner-bottom-left'] = '╰'
 GRAPH_CHAR_UTF8['corner-bottom-right'] = '╯'
 GRAPH_CHAR_UTF8['tree-down-right-mid'] = '├'
 GRAPH_CHAR_UTF8['tree-down-right-end'] = '└'
+GRAPH_CHAR_UTF8['spark'] = '▁▂▃▄▅▆▇█'
 
 GRAPH_CHAR_ASCII = {}
 GRAPH_CHAR_ASCII['degree'] = ' C'
@@ -22,6 +24,7 @@ GRAPH_CHAR_ASCII['corner-bottom-left'] = '+'
 GRAPH_CHAR_ASCII['corner-bottom-right'] = '+'
 GRAPH_CHAR_ASCII['tree-down-right-mid'] = '+'
 GRAPH_CHAR_ASCII['tree-down-right-end'] = '+'
+GRAPH_CHAR_ASCII['spark'] = '_.:-=+*#'
 
 CHAR_MODE_ASCII = "ascii"
 CHAR_MODE_UTF8 = "utf8"
@@ -57,28 +60,39 @@ if os.path.exists(CONF_PATH):
     with open(CONF_PATH) as f:
         CONF = json.loads(f.read())
 else:
-    char_mode = get_char_mode()
     # Defaults if no conf available
     CONF = {
         'max-width' : 800,
         'max-height' : 400,
         'max' : 10000,
-        'char-mode' : char_mode
+        'sample-interval' : 1.0,
+        'collector-intervals' : {},
+        'char-mode' : CHAR_MODE_ASCII
     }
-    with open(CONF_PATH, 'w') as f:
-        f.write(json.dumps(CONF, indent=2))
 
 
-CHAR_MODE = CONF['char-mode']
+GRAPH_CHAR = {}
 
+def use_char_mode(char_mode):
+    # Changed in place, the other modules imported it already
+    GRAPH_CHAR.clear()
+    if char_mode == CHAR_MODE_UTF8:
+        GRAPH_CHAR.update(GRAPH_CHAR_UTF8)
+    elif char_mode == CHAR_MODE_ASCII:
+        GRAPH_CHAR.update(GRAPH_CHAR_ASCII)
+    else:
+        raise Exception("Unexpected char mode '{}'".format(char_mode))
 
-GRAPH_CHAR = {}
-if CHAR_MODE == CHAR_MODE_UTF8:
-    GRAPH_CHAR = GRAPH_CHAR_UTF8
-elif CHAR_MODE == CHAR_MODE_ASCII:
-    GRAPH_CHAR = GRAPH_CHAR_ASCII
-else:
-    raise Exception("Unexpected CHAR_MODE '{}'".format(CHAR_MODE))
+use_char_mode(CONF['char-mode'])
+
+def first_start(interactive):
+    """Without a conf yet, asks for the char mode and saves the conf. Only
+    if interactive (not jill --batch) and with a terminal to ask on."""
+    if interactive and not os.path.exists(CONF_PATH) and sys.stdin.isatty():
+        CONF['char-mode'] = get_char_mode()
+        use_char_mode(CONF['char-mode'])
+        with open(CONF_PATH, 'w') as f:
+            f.write(json.dumps(CONF, indent=2))
 
 BATTERY_INFO = [
     ['charge_full', 'charge_now'],
@@ -1,16 +1,48 @@
+import bisect
+import collections
 import datetime
+import errno
+import fnmatch
+import heapq
+import itertools
+import mmap
 import os
+import pwd
+import re
+import resource
+import socket
 import string
+import struct
 import sys
+import threading
 import time
 import traceback
+import zlib
+
+from array import array
+
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 
-from .conf import GRAPH_CHAR
-from .util import read_single_line, command_as_dict, time_to_str, intersect_y
+from .conf import CONF, GRAPH_CHAR
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .util import read_single_line, command_as_dict, time_to_str
+from .util import PHASE_TIMINGS
+
+# Where the files of the kernel and the system are. Other roots are for
+# benchmarks on made up trees or for looking at a copy of another machine.
+PROC_ROOT = CONF.get('proc-root', '/proc')
+SYS_ROOT = CONF.get('sys-root', '/sys')
+ETC_ROOT = CONF.get('etc-root', '/etc')
 
-POWER_SUPPLY_PATH = '/sys/class/power_supply/'
+# Relative to SYS_ROOT
+POWER_SUPPLY_DIR = 'class/power_supply'
+THERMAL_DIR = 'class/thermal'
 
 class TreeChars:
         def __init__(self, vert_not_last, vert_last, this_not_last, this_last):
@@ -51,150 +83,371 @@ PROC_STAT_DESC = {
 
 		
 
-class CommandCache:
-    def __init__(self):
-        self.command_by_pid = {}
-
-    @staticmethod
-    def _sanitize_string(s):
-        r = ""
-        for c in s:
-            #if (c >= 'A' and c <= 'Z') or (c >= 'a' and c <= 'z'):
-            if ord(c) > 0:
-                r = r + c
-            else:
-                r = r + ' '
-        return r
+# NUL separates the arguments in /proc/<pid>/cmdline
+CMDLINE_TRANSLATION = bytes.maketrans(b"\0", b" ")
+
+# Sparkline glyph for every percentage 0..100, to translate a CpuHistory
+# series decoded as latin-1 (one character per sample) in one call. By the
+# spark characters, the char mode is only known after the first start.
+SPARK_TRANSLATIONS = {}
+
+def spark_translation():
+    spark = GRAPH_CHAR['spark']
+    translation = SPARK_TRANSLATIONS.get(spark)
+    if translation is None:
+        translation = dict((v, spark[v * len(spark) // 101]) for v in range(101))
+        SPARK_TRANSLATIONS[spark] = translation
+    return translation
+
+class ProcessMetadata:
+    def __init__(self, command, comm, uid, selinux_context):
+        self.command = command
+        self.comm = comm
+        self.uid = uid
+        self.selinux_context = selinux_context
+
+class ProcessMetadataCache:
+    """What doesn't change over the lifetime of a process, keyed by
+    (pid, starttime) so a reused pid never gets the data of its predecessor.
+    Entries of processes that are gone are dropped on every scan.
+    With max_entries 0 nothing is cached and everything is read every tick."""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.metadata = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def start_scan(self, live_pids):
+        # The ProcConnector thread inserts between scans
+        with self.lock:
+            for key in [k for k in self.metadata if k[0] not in live_pids]:
+                del self.metadata[key]
+
+    def invalidate(self, pid, starttime):
+        """After an exec the process runs another command"""
+        with self.lock:
+            self.metadata.pop((pid, starttime), None)
+
+    def get(self, proc_reader, pid, starttime, comm):
+        """comm is the undecoded name from /proc/<pid>/stat.
+        Returns None if the process is gone."""
+        key = (pid, starttime)
+        metadata = self.metadata.get(key)
+        if metadata is None:
+            metadata = self._load(proc_reader, pid, comm)
+            if metadata and self.max_entries > 0:
+                # Scanner workers insert concurrently
+                with self.lock:
+                    if len(self.metadata) >= self.max_entries:
+                        del self.metadata[next(iter(self.metadata))]
+                    self.metadata[key] = metadata
+        return metadata
+
+    def _load(self, proc_reader, pid, comm):
+        # Without caching status is read again next tick, worth keeping open
+        uid = proc_reader.read_uid(pid, keep=self.max_entries == 0)
+        if uid is None:
+            return None
+        comm = comm.decode(errors='replace')
+        command = proc_reader.read_cmdline(pid)
+        if command:
+            command = command.translate(CMDLINE_TRANSLATION, b"\n").decode(errors='replace').rstrip()
+        if not command:
+            command = comm if comm else "** command not found **"
+        # The SELinux context is read when it is first asked for
+        return ProcessMetadata(command, comm, uid, None)
+
+
+# Relative to SYS_ROOT and ETC_ROOT
+SELINUX_FS_DIR = 'fs/selinux'
+SELINUX_CONFIG_FILE = 'selinux/config'
+# struct selinux_kernel_status: version, sequence, enforcing, policyload, deny_unknown
+SELINUX_KERNEL_STATUS = struct.Struct("=IIIII")
 
-    def get_command(self, pid):
-        if pid in self.command_by_pid:
-            return self.command_by_pid[pid]
-        try:
-            command_line = read_single_line("/proc/%d/cmdline" % pid)
-            if command_line:
-                command_line = CommandCache._sanitize_string(command_line)
-            else:
-                command_line = read_single_line("/proc/%d/comm" % pid)
-            if not(command_line):
-                command_line = "** command not found **"
-        except:
-            err = traceback.format_exc()
-            command_line = "ERR: %s" % str(err) # + p[1].split("(")[1].split(")")[0]
-        self.command_by_pid[pid] = command_line
-        return command_line
+class SELinuxInfo:
+    """The SELinux status the way sestatus shows it"""
+    def __init__(self, status, policy="n/a", mode="n/a", mls="n/a"):
+        self.status = status
+        self.enabled = self.status == 'enabled'
+        self.policy = policy
+        self.mode = mode
+        self.mls = mls
 
+    def __call__(self):
+        return self.enabled
 
-class SELinuxInfo:
-    def __init__(self):
-        self.reload()
+class SELinuxReader:
+    """Reads the SELinux status from selinuxfs. The kernel bumps a sequence
+    number in its status page on every change of mode or policy, so while
+    nothing changes a tick costs a single read. Only without selinuxfs
+    sestatus is run, and only once, and only for the real /sys."""
+    def __init__(self, sys_root=SYS_ROOT, etc_root=ETC_ROOT):
+        self.fs_path = os.path.join(sys_root, SELINUX_FS_DIR)
+        self.config_path = os.path.join(etc_root, SELINUX_CONFIG_FILE)
+        self.live = sys_root == '/sys'
+        self.status_fd = None
+        self.version = None
+        self.info = None
+
+    def read(self):
+        """The current SELinuxInfo, the same object as before if nothing changed"""
+        version = self._version()
+        if version is None or version != self.version:
+            self.info = self._load(version)
+            self.version = version
+        return self.info
+
+    def _version(self):
+        if not os.path.exists(os.path.join(self.fs_path, 'enforce')):
+            return 'sestatus' if self.live else 'disabled'
+        try:
+            if self.status_fd is None:
+                self.status_fd = os.open(os.path.join(self.fs_path, 'status'), os.O_RDONLY)
+            sequence = SELINUX_KERNEL_STATUS.unpack(os.pread(self.status_fd, SELINUX_KERNEL_STATUS.size, 0))[1]
+        except (OSError, struct.error):
+            # Kernels before 2.6.37 have no status page, read everything
+            return None
+        if sequence % 2:
+            # The kernel is in the middle of an update
+            return None
+        try:
+            config_mtime = os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            config_mtime = None
+        return (sequence, config_mtime)
+
+    def _load(self, version):
+        if version == 'sestatus':
+            return SELinuxReader.run_sestatus()
+        if version == 'disabled':
+            return SELinuxInfo('disabled')
+        policy = "n/a"
+        try:
+            with open(self.config_path) as f:
+                for l in f.read().splitlines():
+                    if l.startswith("SELINUXTYPE="):
+                        policy = l[len("SELINUXTYPE="):].strip()
+        except OSError:
+            pass
+        mode = 'enforcing' if read_single_line(os.path.join(self.fs_path, 'enforce')) == '1' else 'permissive'
+        mls = 'enabled' if read_single_line(os.path.join(self.fs_path, 'mls')) == '1' else 'disabled'
+        return SELinuxInfo('enabled', policy, mode, mls)
 
-    def reload(self):
+    @staticmethod
+    def run_sestatus():
         try:
             values = command_as_dict('sestatus', ':')
         except FileNotFoundError:
-            self.status = "n/a"
-            self.enabled = False
-            self.policy = "n/a"
-            self.mode = "n/a"
-            self.mls = "n/a"
-            return
-        self.status = values['SELinux status']
-        self.enabled = self.status == 'enabled'
-        self.policy = values['Loaded policy name']
-        self.mode = values['Current mode']
-        self.mls = values['Policy MLS status']
-        #logging.info("SELinux Stuff")
-        #for k in values.keys():
-        #    logging.info(" '{}' -> '{}'".format(k, values[k]))
-        #logging.info("SELinux Stuff done.")
-
-    def __call__(self):
-        return self.enabled
+            return SELinuxInfo("n/a")
+        if values['SELinux status'] != 'enabled':
+            return SELinuxInfo(values['SELinux status'])
+        return SELinuxInfo(values['SELinux status'], values['Loaded policy name'], values['Current mode'], values['Policy MLS status'])
 
 #############################################################################
 # /etc user modelling
 #############################################################################
 
+# Relative to ETC_ROOT
+PASSWD_FILE = 'passwd'
+# Uids neither /etc/passwd nor NSS know are asked again after this long
+UNKNOWN_UID_RETRY_SECONDS = 60
+
+class NssUsers:
+    """Usernames of uids that are not in /etc/passwd but maybe in LDAP,
+    SSSD or another NSS source, asked through the pwd module"""
+    def __init__(self, retry_seconds):
+        self.retry_seconds = retry_seconds
+        self.names = {}
+        self.unknown_until = {}
+
+    def username(self, uid):
+        name = self.names.get(uid)
+        if name is not None:
+            return name
+        now = time.monotonic()
+        if self.unknown_until.get(uid, 0) > now:
+            return str(uid)
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            self.unknown_until[uid] = now + self.retry_seconds
+            return str(uid)
+        self.names[uid] = name
+        return name
+
 class UserSnapshot:
-    def __init__(self):
+    def __init__(self, nss_users=None, passwd_path=os.path.join(ETC_ROOT, PASSWD_FILE)):
+        self.nss_users = nss_users
         self.username_by_uid = {}
-        with open("/etc/passwd", 'r') as f:
-            for l in f.read().splitlines():
-                parts = l.split(":")
-                username = parts[0]
-                uid = int(parts[2])
-                self.username_by_uid[uid] = username
+        try:
+            with open(passwd_path, 'r') as f:
+                for l in f.read().splitlines():
+                    parts = l.split(":")
+                    if len(parts) < 3 or not parts[2].isdigit():
+                        continue
+                    username = parts[0]
+                    uid = int(parts[2])
+                    self.username_by_uid[uid] = username
+        except OSError:
+            logging.error(traceback.format_exc())
+
+    def username(self, uid):
+        """The name of the user, the uid as string if nobody knows it"""
+        name = self.username_by_uid.get(uid)
+        if name is not None:
+            return name
+        if self.nss_users is not None:
+            return self.nss_users.username(uid)
+        return str(uid)
+
+class UserDatabase:
+    """Hands out UserSnapshots, a new one only when /etc/passwd changed"""
+    def __init__(self, etc_root=ETC_ROOT):
+        self.passwd_path = os.path.join(etc_root, PASSWD_FILE)
+        self.nss_users = NssUsers(UNKNOWN_UID_RETRY_SECONDS)
+        self.version = None
+        self.user_snapshot = None
+
+    def current(self):
+        try:
+            st = os.stat(self.passwd_path)
+            version = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            version = None
+        if self.user_snapshot is None or version != self.version:
+            self.user_snapshot = UserSnapshot(self.nss_users, self.passwd_path)
+            self.version = version
+        return self.user_snapshot
 
 
 #############################################################################
 # /proc modelling
 #############################################################################
-def find_battery_paths():
+def find_battery_paths(sys_root=SYS_ROOT):
     paths = []
-    for cand in os.listdir(POWER_SUPPLY_PATH):
-        if os.path.exists(os.path.join(POWER_SUPPLY_PATH, cand, 'capacity')):
+    power_supply_path = os.path.join(sys_root, POWER_SUPPLY_DIR)
+    for cand in os.listdir(power_supply_path):
+        if os.path.exists(os.path.join(power_supply_path, cand, 'capacity')):
             paths.append(cand)
     return paths
 
 class PowerSnapshot:
-    def __init__(self, battery_path):
+    """Status and capacity of a battery, both from its uevent file"""
+    def __init__(self, supply_path):
         self.time = time.time()
-        self.capacity = int(read_single_line(os.path.join(POWER_SUPPLY_PATH, battery_path, 'capacity')))
-        self.status = read_single_line(os.path.join(POWER_SUPPLY_PATH, battery_path, 'status'))
+        values = {}
+        with open(os.path.join(supply_path, 'uevent')) as f:
+            for l in f:
+                key, sep, value = l.rstrip("\n").partition("=")
+                if sep:
+                    values[key] = value
+        capacity = values.get('POWER_SUPPLY_CAPACITY')
+        if capacity is None:
+            capacity = read_single_line(os.path.join(supply_path, 'capacity'))
+        self.capacity = int(capacity)
+        self.status = values.get('POWER_SUPPLY_STATUS', 'Unknown')
 
     def __str__(self):
-        return "PowerSnapshot[{}, {}, {}, {}".format(self.name, self.charge_full, self.charge_now, self.status)
+        return "PowerSnapshot[{}, {}, {}]".format(self.time, self.capacity, self.status)
+
+class BatteryHistory:
+    """The last size (time, capacity) samples in a ring buffer. The sums for
+    a least squares line through them are kept up to date, so adding a
+    sample and estimating cost the same however many samples there are.
+    Times are relative to the first sample, squared epoch seconds would
+    lose all precision."""
+    def __init__(self, size):
+        self.size = max(2, size)
+        self.times = array('d', bytes(8 * self.size))
+        self.capacities = array('d', bytes(8 * self.size))
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.next = 0
+        self.t0 = None
+        self.sum_t = 0.0
+        self.sum_c = 0.0
+        self.sum_tt = 0.0
+        self.sum_tc = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, t, capacity):
+        if self.t0 is None:
+            self.t0 = t
+        t -= self.t0
+        if self.count == self.size:
+            old_t = self.times[self.next]
+            old_c = self.capacities[self.next]
+            self.sum_t -= old_t
+            self.sum_c -= old_c
+            self.sum_tt -= old_t * old_t
+            self.sum_tc -= old_t * old_c
+        else:
+            self.count += 1
+        self.times[self.next] = t
+        self.capacities[self.next] = capacity
+        self.sum_t += t
+        self.sum_c += capacity
+        self.sum_tt += t * t
+        self.sum_tc += t * capacity
+        self.next = (self.next + 1) % self.size
+        if self.next == 0:
+            # Once per round, so rounding errors of the subtractions don't pile up
+            self.sum_t = sum(self.times[:self.count])
+            self.sum_c = sum(self.capacities[:self.count])
+            self.sum_tt = sum(t * t for t in self.times[:self.count])
+            self.sum_tc = sum(t * c for t, c in zip(self.times[:self.count], self.capacities[:self.count]))
+
+    def time_at(self, capacity):
+        """When the line through the samples reaches capacity, None if it's flat"""
+        n = self.count
+        d = n * self.sum_tt - self.sum_t * self.sum_t
+        if n < 2 or d <= 0:
+            return None
+        slope = (n * self.sum_tc - self.sum_t * self.sum_c) / d
+        if slope == 0:
+            return None
+        intercept = (self.sum_c - slope * self.sum_t) / n
+        return self.t0 + (capacity - intercept) / slope
 
 class PowerInfo:
-    def __init__(self, battery_path):
+    def __init__(self, battery_path, sys_root=SYS_ROOT):
         self.battery_path = battery_path
-        self.snapshots = []
+        self.supply_path = os.path.join(sys_root, POWER_SUPPLY_DIR, battery_path)
+        self.history = BatteryHistory(CONF.get('battery-history', 64))
+        self.status = None
+        self.capacity = None
+        self.time_remaining_str = ''
         self.take_snapshot()
 
     def take_snapshot(self):
-        new_snapshot = PowerSnapshot(self.battery_path)
-        needs_update = False
-        if self.snapshots:
-            latest_snapshot = self.snapshots[len(self.snapshots) - 1]
-            if new_snapshot.status != latest_snapshot.status:
-                self.snapshots = [new_snapshot]
-                needs_update = True
-            else:
-                if latest_snapshot.capacity != new_snapshot.capacity:
-                    self.snapshots.append(new_snapshot)
-                    needs_update = True
-        else:
-            self.snapshots.append(new_snapshot)
-            needs_update = True
-        if not needs_update:
+        new_snapshot = PowerSnapshot(self.supply_path)
+        if new_snapshot.status != self.status:
+            self.history.clear()
+        elif new_snapshot.capacity == self.capacity:
             return
+        # A sample whenever the capacity changes
+        self.history.add(new_snapshot.time, new_snapshot.capacity)
         self.status = new_snapshot.status
         self.capacity = new_snapshot.capacity
-        if len(self.snapshots) > 2:
-            last = self.snapshots[len(self.snapshots) - 1]
-            for s in self.snapshots[:len(self.snapshots)-1]:
-                if self.status == 'Discharging' or self.status == "Not charging":
-                    sec = intersect_y(s.time, s.capacity, last.time, last.capacity, 5.0)
-                    if sec:
-                        remain = sec - last.time
-                    else:
-                        remain = None
-                elif self.status == 'Charging':
-                    sec = intersect_y(s.time, s.capacity, last.time, last.capacity, 100.0)
-                    if sec:
-                        remain = sec - last.time
-                    else:
-                        remain = None
-                else:
-                    remain = None
-                if remain:
-                    txt = time_to_str(remain, False)
-                else:
-                    txt = ''
-                #logging.info("Power {}-{} : {}".format(time_to_str(s.time, False), time_to_str(last.time, False), txt))
-                self.time_remaining_str = txt
-        else:
-            self.time_remaining_str = ''
+        self.time_remaining_str = ''
+        if len(self.history) > 2:
+            if self.status == 'Discharging' or self.status == "Not charging":
+                target = 5.0
+            elif self.status == 'Charging':
+                target = 100.0
+            else:
+                return
+            sec = self.history.time_at(target)
+            if sec:
+                remain = sec - new_snapshot.time
+                if remain > 0:
+                    self.time_remaining_str = time_to_str(remain, False)
 
 class ThermalZone:
     def __init__(self, zone_type, zone_temp):
@@ -202,12 +455,16 @@ class ThermalZone:
         self.zone_temp = zone_temp
 
 class ThermalInfo:
-    def __init__(self):
+    def __init__(self, thermal_zones=None, sys_root=SYS_ROOT):
+        if thermal_zones is not None:
+            self.thermal_zones = thermal_zones
+            return
         self.thermal_zones = []
-        for tz in os.listdir("/sys/class/thermal"):
+        thermal_path = os.path.join(sys_root, THERMAL_DIR)
+        for tz in os.listdir(thermal_path):
             if "thermal_zone" in tz:
-                zone_type = read_single_line("/sys/class/thermal/%s/type" % tz)
-                zone_temp = read_single_line("/sys/class/thermal/%s/temp" % tz)
+                zone_type = read_single_line(os.path.join(thermal_path, tz, "type"))
+                zone_temp = read_single_line(os.path.join(thermal_path, tz, "temp"))
                 if zone_temp:
                     fmt = "%0.0f%s" % (float(zone_temp) / 1000.0, GRAPH_CHAR['degree'])
                 else:
@@ -215,35 +472,129 @@ class ThermalInfo:
                 self.thermal_zones.append(ThermalZone(zone_type, fmt))
 
 class MemInfoSnapshot:
-    def __init__(self):
+    def __init__(self, values=None, proc_root=PROC_ROOT):
+        if values is not None:
+            self.values = values
+            return
         self.values = {}
-        with open("/proc/meminfo") as f:
+        with open(os.path.join(proc_root, "meminfo")) as f:
             txt = f.read()
             for l in txt.splitlines():
                 kv = l.split(":")
                 self.values[kv[0]] = kv[1].strip()
 
 class MemMapsSnapshot:
-    def __init__(self, pid):
+    """Adds up the sizes of the writable mappings, streamed line by line"""
+    def __init__(self, pid, proc_root=PROC_ROOT):
         try:
-            self.rw_mem = self._calc_sum(pid)
+            self.rw_mem = self._calc_sum(pid, proc_root)
         except PermissionError:
             self.rw_mem = 0;
         except FileNotFoundError:
             self.rw_mem = 0;
 
-    def _calc_sum(self, pid):
+    def _calc_sum(self, pid, proc_root):
         sum = 0
-        with open("/proc/%d/maps" % pid) as f:
-            for l in f.read().splitlines():
-                parts = l.split(" ")
-                addr = parts[0].split("-")
+        with open("%s/%d/maps" % (proc_root, pid)) as f:
+            for l in f:
+                parts = l.split(" ", 2)
                 if "rw" in parts[1]:
+                    addr = parts[0].split("-")
                     low = int(addr[0], 16)
                     high = int(addr[1], 16)
                     sum += (high -low)
         return sum
 
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+class ProcessMemory:
+    """Memory of one process in bytes, None where the source doesn't tell"""
+    def __init__(self, rss=None, pss=None, swap=None, writable=None):
+        self.rss = rss
+        self.pss = pss
+        self.swap = swap
+        self.writable = writable
+
+def read_process_memory(pid, proc_root=PROC_ROOT):
+    """From smaps_rollup where we may read it (it needs ptrace access),
+    else statm and status, which everybody may read. Adding up the
+    writable mappings in maps is the last resort. Never the whole smaps.
+    An empty ProcessMemory if the process is gone."""
+    try:
+        values = {}
+        with open("%s/%d/smaps_rollup" % (proc_root, pid)) as f:
+            for l in f:
+                parts = l.split()
+                if parts[0] in ("Rss:", "Pss:", "Swap:"):
+                    values[parts[0]] = int(parts[1]) * 1024
+        return ProcessMemory(rss=values.get("Rss:"), pss=values.get("Pss:"), swap=values.get("Swap:"))
+    except OSError:
+        pass
+    try:
+        with open("%s/%d/statm" % (proc_root, pid)) as f:
+            statm = f.read().split()
+    except FileNotFoundError:
+        return ProcessMemory()
+    except OSError:
+        return ProcessMemory(writable=MemMapsSnapshot(pid, proc_root).rw_mem)
+    swap = None
+    try:
+        with open("%s/%d/status" % (proc_root, pid)) as f:
+            for l in f:
+                if l.startswith("VmSwap:"):
+                    swap = int(l.split()[1]) * 1024
+    except OSError:
+        pass
+    # statm: size resident shared text lib data dt, in pages. data includes the stack.
+    return ProcessMemory(rss=int(statm[1]) * PAGE_SIZE, swap=swap, writable=int(statm[5]) * PAGE_SIZE)
+
+class ProcessMemoryCache:
+    """ProcessMemory of the processes someone looks at, read on a worker
+    thread: smaps_rollup of a big JVM can take the kernel a while. get()
+    answers from the cache right away and asks for a new reading once the
+    last one is older than ttl seconds."""
+    MAX_ENTRIES = 64
+
+    def __init__(self, ttl, proc_root=PROC_ROOT):
+        self.ttl = ttl
+        self.proc_root = proc_root
+        self.entries = collections.OrderedDict() # (pid, starttime) -> [ProcessMemory, time]
+        self.pending = set()
+        self.lock = threading.Lock()
+        # Bumped whenever a reading arrives, to know when to redraw
+        self.generation = 0
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="jill-memory")
+
+    def get(self, pid, starttime):
+        """The last reading of the process, None before the first one"""
+        key = (pid, starttime)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            if (entry is None or now - entry[1] >= self.ttl) and key not in self.pending:
+                self.pending.add(key)
+                self.executor.submit(self._read, key)
+        return entry[0] if entry is not None else None
+
+    def _read(self, key):
+        try:
+            memory = read_process_memory(key[0], self.proc_root)
+        except Exception:
+            logging.error(traceback.format_exc())
+            memory = ProcessMemory()
+        with self.lock:
+            self.pending.discard(key)
+            self.entries[key] = [memory, time.monotonic()]
+            self.entries.move_to_end(key)
+            while len(self.entries) > ProcessMemoryCache.MAX_ENTRIES:
+                self.entries.popitem(last=False)
+            self.generation += 1
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
 
 class CpuInfo:
     def __init__(self, values):
@@ -264,13 +615,25 @@ class CpuInfo:
     def usage_time_since_boot(self):
         return self.time_since_boot() - self.idle_time_since_boot()
 
+CPU_INFO_FIELDS = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal', 'guest', 'guest_nice')
+
+def cpu_counters(cpu_snapshot):
+    """All counters of a CpuSnapshot, the total first, in one array"""
+    counters = array('q')
+    for cpu_info in [cpu_snapshot.total_cpu_info] + cpu_snapshot.single_cpu_infos:
+        counters.extend(getattr(cpu_info, f) for f in CPU_INFO_FIELDS)
+    return counters
+
+def read_uptime(proc_root=PROC_ROOT):
+    with open(os.path.join(proc_root, "uptime"), 'r') as f:
+        return float(f.read().split(" ")[0])
+
 class CpuSnapshot:
-    def __init__(self):
+    def __init__(self, proc_root=PROC_ROOT):
         self.single_cpu_infos = []
         self.total_cpu_info = None
-        with open("/proc/uptime", 'r') as f:
-            self.uptime = float(f.read().split(" ")[0])
-        with open("/proc/stat", 'r') as f:
+        self.uptime = read_uptime(proc_root)
+        with open(os.path.join(proc_root, "stat"), 'r') as f:
             for line in f.read().splitlines():
                 if line.startswith("cpu "): # global
                     self.total_cpu_info = CpuInfo([int(v) for v in line.split(" ")[2:]])
@@ -279,52 +642,408 @@ class CpuSnapshot:
                 else:
                     pass # ignore this line
 
+    @staticmethod
+    def from_counters(uptime, counters):
+        """A snapshot of recorded counters, see cpu_counters"""
+        cpu_snapshot = CpuSnapshot.__new__(CpuSnapshot)
+        cpu_snapshot.uptime = uptime
+        n = len(CPU_INFO_FIELDS)
+        cpu_infos = [CpuInfo(counters[i:i + n]) for i in range(0, len(counters), n)]
+        cpu_snapshot.total_cpu_info = cpu_infos[0]
+        cpu_snapshot.single_cpu_infos = cpu_infos[1:]
+        return cpu_snapshot
+
     def format_uptime(self):
         t = int(self.uptime)
         return time_to_str(t, True)
 
 
-class ProcessInfo:
-    def __init__(self, selinux_enabled, uptime, uid, pid, state, ppid, comm, utime, stime, cutime, cstime, starttime, vsize):
-        self.uptime = uptime
-        self.uid = uid
-        self.pid = pid
-        self.state = state
-        self.ppid = ppid
-        self.comm = comm
-        self.utime = utime
-        self.stime = stime
-        self.cutime = cutime
-        self.cstime = cstime
-        self.starttime = starttime
-        self.vsize = vsize
-        self.children = []
-        self.parent = None
-
-        if selinux_enabled:
-            fullstr = read_single_line("/proc/{}/attr/current".format(pid))
-            if fullstr:
-                fullstr = fullstr[:-1]
-                parts = fullstr.split(':')
-                self.selinux_1 = ":".join(parts[:3])
-                if len(parts) >= 4:
-                    self.selinux_2 = parts[3]
-                    if len(parts) >= 5:
-                        self.selinux_3 = ":".join(parts[4:])
-                    else:
-                        self.selinux_3 = ""
-                else:
-                    self.selinux_2 = ""
-                    self.selinux_3 = ""
+class CpuHistory:
+    """CPU usage in percent of the last size samples, total and per core.
+    One byte per sample in a ring buffer per series."""
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.series = [] # total, core 0, core 1, ...
+        self.next = 0
+        self.count = 0
+
+    def add(self, cpu_delta):
+        values = [cpu_delta.total_cpu_percentage] + list(cpu_delta.cpu_percentages)
+        if len(values) != len(self.series):
+            # The first sample, or CPUs went on- or offline
+            self.series = [array('B', bytes(self.size)) for v in values]
+            self.next = 0
+            self.count = 0
+        for series, value in zip(self.series, values):
+            series[self.next] = min(100, max(0, int(round(value))))
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def snapshot(self):
+        series = []
+        for s in self.series:
+            b = s.tobytes()
+            series.append(b[:self.count] if self.count < self.size else b[self.next:] + b[:self.next])
+        return CpuHistorySnapshot(series)
+
+class CpuHistorySnapshot:
+    """A copy of the CpuHistory for one ModelState, bytes per series, oldest first"""
+    def __init__(self, series):
+        self.total = series[0] if series else b""
+        self.cores = series[1:]
+
+    @staticmethod
+    def sparkline(series):
+        return series.decode('latin-1').translate(spark_translation())
+
+    @staticmethod
+    def peak_glyph(series):
+        return spark_translation()[max(series)] if series else " "
+
+
+def raise_open_file_limit(max_fds):
+    # Some head room for everything else jill opens
+    wanted = max_fds + 256
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        except (ValueError, OSError):
+            logging.error("Can't raise open file limit to {}".format(wanted))
+
+class ProcFilePool:
+    """Keeps /proc/<pid>/<name> files open between ticks and re-reads them
+    with preadv at offset 0. A descriptor stays valid for the process it
+    was opened for, reading fails with ESRCH once it's gone, so pid reuse
+    can't hand out data of another process. The path is opened once more
+    then, the pid may already belong to a new process.
+    Above max_fds the least recently used descriptor is closed, but never
+    one used in the current scan: jill reads pids in the same order every
+    tick, plain LRU would evict exactly what's needed next. Files that
+    don't fit are opened, read and closed like before."""
+    def __init__(self, max_fds, proc_root=PROC_ROOT):
+        self.max_fds = max_fds
+        self.proc_root = proc_root
+        self.path_format = proc_root + "/%d/%s"
+        self.scan = 0
+        self.names = set()
+        self.fds = collections.OrderedDict() # (pid, name) -> [fd, scan]
+
+    def __len__(self):
+        return len(self.fds)
+
+    def start_scan(self, live_pids):
+        """Closes descriptors of processes that are gone"""
+        self.scan += 1
+        for key in [k for k in self.fds if k[0] not in live_pids]:
+            self._close(key)
+
+    def forget(self, pid):
+        for name in self.names:
+            if (pid, name) in self.fds:
+                self._close((pid, name))
+
+    def close_all(self):
+        for key in list(self.fds):
+            self._close(key)
+
+    def _close(self, key):
+        fd = self.fds.pop(key)[0]
+        os.close(fd)
+
+    def _make_room(self):
+        while len(self.fds) >= self.max_fds:
+            oldest = next(iter(self.fds.values()), None)
+            if oldest is None or oldest[1] == self.scan:
+                return False
+            self._close(next(iter(self.fds)))
+        return True
+
+    def readinto(self, pid, name, buffer, keep=True, reopen=True):
+        """Reads the file into buffer, returns the number of bytes read.
+        Returns 0 if the file can't be read (process is gone), raises
+        PermissionError if it isn't ours to read."""
+        key = (pid, name)
+        entry = self.fds.get(key)
+        if entry is None:
+            try:
+                fd = os.open(self.path_format % key, os.O_RDONLY)
+            except PermissionError:
+                raise
+            except OSError:
+                return 0
+            if keep and self._make_room():
+                entry = [fd, self.scan]
+                self.fds[key] = entry
+                self.names.add(name)
             else:
-                self.selinux_1 = "?"
-                self.selinux_2 = "?"
-                self.selinux_3 = "?"
+                try:
+                    return os.preadv(fd, [buffer], 0)
+                except PermissionError:
+                    raise
+                except OSError:
+                    return 0
+                finally:
+                    os.close(fd)
         else:
-            self.selinux_1 = None
-            self.selinux_2 = None
-            self.selinux_3 = None
-        
+            entry[1] = self.scan
+            self.fds.move_to_end(key)
+        try:
+            return os.preadv(entry[0], [buffer], 0)
+        except PermissionError:
+            self._close(key)
+            raise
+        except OSError as e:
+            if e.errno in (errno.ESRCH, errno.ENOENT):
+                # process is gone, but not necessarily its pid
+                self.forget(pid)
+                if reopen:
+                    return self.readinto(pid, name, buffer, keep, False)
+            else:
+                self._close(key)
+            return 0
+
+
+class ProcReader:
+    """Reads /proc/<pid> files as bytes into one buffer that is reused for
+    every pid. Not thread safe, every thread needs its own reader."""
+    BUFFER_SIZE = 4096
+
+    def __init__(self, proc_files=None):
+        self.buffer = bytearray(ProcReader.BUFFER_SIZE)
+        self.proc_files = proc_files if proc_files is not None else ProcFilePool(0)
+
+    def read_stat(self, pid):
+        try:
+            size = self.proc_files.readinto(pid, 'stat', self.buffer)
+        except PermissionError:
+            # hidepid
+            return None
+        if not size:
+            return None
+        return parse_stat(self.buffer, size)
+
+    def read_cmdline(self, pid):
+        # No size limit, doesn't go through the buffer
+        try:
+            with open("%s/%d/cmdline" % (self.proc_files.proc_root, pid), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def read_io(self, pid):
+        """(read_bytes, write_bytes) from /proc/<pid>/io, None if the
+        process is gone. Raises PermissionError if it isn't ours to read."""
+        size = self.proc_files.readinto(pid, 'io', self.buffer)
+        read_start = self.buffer.find(b"\nread_bytes:", 0, size)
+        write_start = self.buffer.find(b"\nwrite_bytes:", 0, size)
+        if read_start < 0 or write_start < 0:
+            return None
+        return (int(self.buffer[read_start + 12:size].split(None, 1)[0]),
+                int(self.buffer[write_start + 13:size].split(None, 1)[0]))
+
+    def read_uid(self, pid, keep=True):
+        """Real uid from /proc/<pid>/status, None if the process is gone"""
+        try:
+            size = self.proc_files.readinto(pid, 'status', self.buffer, keep)
+        except PermissionError:
+            return None
+        start = self.buffer.find(b"\nUid:", 0, size)
+        if start < 0:
+            return None
+        return int(self.buffer[start + 5:size].split(None, 1)[0])
+
+# Field positions in what follows "(comm) " in /proc/<pid>/stat
+STAT_STATE = 0
+STAT_PPID = 1
+STAT_UTIME = 11
+STAT_STIME = 12
+STAT_CUTIME = 13
+STAT_CSTIME = 14
+STAT_STARTTIME = 19
+STAT_VSIZE = 20
+
+def parse_stat(buf, size):
+    """Parses the first size bytes of a /proc/<pid>/stat record in one pass.
+    comm may contain anything, including spaces and parentheses, but it's
+    always followed by the last ')' of the record.
+    Returns (pid, comm, state, ppid, utime, stime, cutime, cstime, starttime, vsize)
+    with comm as undecoded bytes and state as the value of its single byte."""
+    comm_end = buf.rfind(b')', 0, size)
+    comm_start = buf.find(b'(', 0, comm_end)
+    if comm_start < 0 or comm_end < 0:
+        raise Exception("Can't parse stat record '{}'".format(bytes(buf[:size])))
+    fields = buf[comm_end + 2:size].split(None, STAT_VSIZE + 1)
+    return (
+        int(buf[:comm_start - 1]),
+        bytes(buf[comm_start + 1:comm_end]),
+        fields[STAT_STATE][0],
+        int(fields[STAT_PPID]),
+        int(fields[STAT_UTIME]),
+        int(fields[STAT_STIME]),
+        int(fields[STAT_CUTIME]),
+        int(fields[STAT_CSTIME]),
+        int(fields[STAT_STARTTIME]),
+        int(fields[STAT_VSIZE])
+    )
+
+def read_selinux_context(pid, proc_root=PROC_ROOT):
+    fullstr = read_single_line("{}/{}/attr/current".format(proc_root, pid))
+    if fullstr:
+        fullstr = fullstr[:-1]
+        parts = fullstr.split(':')
+        selinux_1 = ":".join(parts[:3])
+        if len(parts) >= 4:
+            selinux_2 = parts[3]
+            if len(parts) >= 5:
+                selinux_3 = ":".join(parts[4:])
+            else:
+                selinux_3 = ""
+        else:
+            selinux_2 = ""
+            selinux_3 = ""
+        return selinux_1, selinux_2, selinux_3
+    else:
+        return "?", "?", "?"
+
+class ProcessTable:
+    """All processes of one scan as columns, one typed array per counter
+    and one row per process, rows ordered by pid. The constant facts of a
+    process are shared with the metadata cache. proc_root is where the
+    rows came from, for what is read later on."""
+    def __init__(self, uptime, proc_root=PROC_ROOT):
+        self.uptime = uptime
+        self.proc_root = proc_root
+        self.pid = array('i')
+        self.ppid = array('i') # -1 for no parent
+        self.state = bytearray()
+        self.utime = array('q')
+        self.stime = array('q')
+        self.cutime = array('q')
+        self.cstime = array('q')
+        self.starttime = array('q')
+        self.vsize = array('q')
+        self.metadata = []
+
+    def __len__(self):
+        return len(self.pid)
+
+    def append(self, pid, ppid, state, utime, stime, cutime, cstime, starttime, vsize, metadata):
+        self.pid.append(pid)
+        self.ppid.append(ppid)
+        self.state.append(state)
+        self.utime.append(utime)
+        self.stime.append(stime)
+        self.cutime.append(cutime)
+        self.cstime.append(cstime)
+        self.starttime.append(starttime)
+        self.vsize.append(vsize)
+        self.metadata.append(metadata)
+
+    def append_row(self, other, row):
+        self.append(other.pid[row], other.ppid[row], other.state[row],
+                    other.utime[row], other.stime[row], other.cutime[row], other.cstime[row],
+                    other.starttime[row], other.vsize[row], other.metadata[row])
+
+    def find(self, pid):
+        """Row of pid, -1 if there's no such process"""
+        row = bisect.bisect_left(self.pid, pid)
+        if row < len(self.pid) and self.pid[row] == pid:
+            return row
+        return -1
+
+    @staticmethod
+    def merged(uptime, tables):
+        """Merges tables with disjoint pids into one, in pid order"""
+        result = ProcessTable(uptime, tables[0].proc_root if tables else PROC_ROOT)
+        keyed_rows = [zip(t.pid, itertools.repeat(t), range(len(t))) for t in tables]
+        for pid, table, row in heapq.merge(*keyed_rows, key=lambda k: k[0]):
+            result.append_row(table, row)
+        return result
+
+ROOT_METADATA = ProcessMetadata("Root", "Root", 0, None)
+
+class ProcessInfo:
+    """View of one row of a ProcessTable, made when needed"""
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def uptime(self):
+        return self.table.uptime
+
+    @property
+    def pid(self):
+        return self.table.pid[self.row]
+
+    @property
+    def ppid(self):
+        ppid = self.table.ppid[self.row]
+        return None if ppid < 0 else ppid
+
+    @property
+    def state(self):
+        return chr(self.table.state[self.row])
+
+    @property
+    def uid(self):
+        return self.table.metadata[self.row].uid
+
+    @property
+    def comm(self):
+        return self.table.metadata[self.row].command
+
+    @property
+    def utime(self):
+        return self.table.utime[self.row]
+
+    @property
+    def stime(self):
+        return self.table.stime[self.row]
+
+    @property
+    def cutime(self):
+        return self.table.cutime[self.row]
+
+    @property
+    def cstime(self):
+        return self.table.cstime[self.row]
+
+    @property
+    def starttime(self):
+        return self.table.starttime[self.row]
+
+    @property
+    def vsize(self):
+        return self.table.vsize[self.row]
+
+    def selinux_context(self):
+        """Read on first use, it is only shown for the selected process"""
+        metadata = self.table.metadata[self.row]
+        if metadata.selinux_context is None:
+            metadata.selinux_context = read_selinux_context(self.pid, self.table.proc_root)
+        return metadata.selinux_context
+
+    @property
+    def selinux_1(self):
+        context = self.selinux_context()
+        return context[0] if context else None
+
+    @property
+    def selinux_2(self):
+        context = self.selinux_context()
+        return context[1] if context else None
+
+    @property
+    def selinux_3(self):
+        context = self.selinux_context()
+        return context[2] if context else None
+
     def cpu_usage_this(self):
         total_time = self.utime + self.stime
         seconds = self.uptime - (self.starttime / CLOCK_TICKS)
@@ -346,205 +1065,687 @@ class ProcessInfo:
 
 
 class ProcessTreeLine:
-    def __init__(self, user_snapshot, process_delta, max_pid, process_info, parents_last, this_last):
+    def __init__(self, user_snapshot, process_delta, max_pid, process_info, prefix):
+        self.user_snapshot = user_snapshot
+        self.process_delta = process_delta
         self.process_info = process_info
-        self.parents_last = parents_last
-        self.this_last = this_last
+        self.prefix = prefix
         self.max_pid = max_pid
-        self.values = {}
+        self._values = None
+
+    @property
+    def values(self):
+        """Formatted on first use, most lines of a long tree are never shown"""
+        if self._values is None:
+            self._values = self._format_values()
+        return self._values
+
+    def _format_values(self):
+        process_info = self.process_info
+        values = {}
         try:
-            self.values['UID'] = user_snapshot.username_by_uid[process_info.uid]
-        except KeyError:
-            logging.error("User {} not found in /etc/passwd".format(process_info.uid))
-            self.values['UID'] = str(process_info.uid)
-        try:
-            self.values['PID'] = str(process_info.pid)
-            self.values['PPID'] = str(process_info.ppid)
-            self.values['STIME'] = time_to_str(self.process_info.starttime, False)
-            self.values['VSIZE'] = str(int(process_info.vsize/1000000)).rjust(6)+" MB"
-            self.values['CPU'] = "%d%%" % int(process_delta.cpu_usage(process_info.pid))
-            self.values['COMMAND'] = self.get_command_str()
+            values['UID'] = self.user_snapshot.username(process_info.uid)
+            values['PID'] = str(process_info.pid)
+            values['PPID'] = str(process_info.ppid)
+            values['STIME'] = time_to_str(process_info.starttime, False)
+            values['VSIZE'] = str(int(process_info.vsize/1000000)).rjust(6)+" MB"
+            values['CPU'] = "%d%%" % int(self.cpu_usage())
+            values['COMMAND'] = self.get_command_str()
         except Exception:
             logging.error(traceback.format_exc())
-            self.values['UID'] = "?"
-            self.values['PID'] = "?"
-            self.values['PPID'] = "?"
-            self.values['STIME'] = "?"
-            self.values['VSIZE'] = "?"
-            self.values['CPU'] = "?"
-            self.values['COMMAND'] = "?"
-            
+            values['UID'] = "?"
+            values['PID'] = "?"
+            values['PPID'] = "?"
+            values['STIME'] = "?"
+            values['VSIZE'] = "?"
+            values['CPU'] = "?"
+            values['COMMAND'] = "?"
+        return values
+
+    def cpu_usage(self):
+        return self.process_delta.cpu_usage(self.process_info.pid)
+
+    def io_rate(self):
+        return self.process_delta.io_rate(self.process_info.pid)
+
     def get_command_str(self):
-        s = ""
-        tc = TREE_CHARS
-        for pl in self.parents_last:
-            if pl:
-                s += tc.vert_last
+        return self.prefix + self.process_info.comm
+
+class ThreadTreeLine(ProcessTreeLine):
+    """A thread of an expanded process, its ppid is the process"""
+    def cpu_usage(self):
+        return self.process_delta.thread_cpu_usage(self.process_info.ppid, self.process_info.pid)
+
+    def io_rate(self):
+        # Counted for the whole process
+        return None
+
+
+class FilterMatcher:
+    """One filter field of the process view. "/expr" is a regular expression
+    searched for, text with * ? or [ a glob for the whole value, anything else
+    a plain substring."""
+    def __init__(self, text):
+        self.text = text
+        self.substring = None
+        self.literal = None # every matching value contains it
+        self._match = None
+        if text.startswith("/") and len(text) > 1:
+            try:
+                self._match = re.compile(text[1:]).search
+            except re.error:
+                # Half typed, use it literally until it compiles
+                self.substring = text[1:]
+                self.literal = self.substring
+        elif any(c in text for c in "*?["):
+            self._match = re.compile(fnmatch.translate(text)).match
+            pieces = re.split(r"[*?\0]", re.sub(r"\[[^\]]*\]?", "\0", text))
+            self.literal = max(pieces, key=len)
+        else:
+            self.substring = text
+            self.literal = text
+
+    def matches(self, value):
+        if self.substring is not None:
+            return self.substring in value
+        return self._match(value) is not None
+
+    def narrows(self, previous):
+        """True if everything this matches was matched by previous"""
+        if previous is None:
+            return True
+        if self.substring is not None and previous.substring is not None:
+            return previous.substring in self.substring
+        return self.text == previous.text
+
+class CommandIndex:
+    """Trigram index over the distinct command lines of the processes in a
+    ProcessTable. Following the next table only touches the processes that
+    appeared, went away or changed their command line. Postings are append
+    only arrays of command ids, ids of commands no process runs any more are
+    dropped when they outnumber the live ones."""
+    MAX_INDEXED_LENGTH = 4096
+
+    def __init__(self):
+        self.table = None
+        self.command_by_pid = {}
+        self._clear()
+
+    def _clear(self):
+        self.commands = [] # id -> command, None when no process runs it
+        self.entries = {} # command -> [id, pids]
+        self.postings = {} # trigram -> array of ids
+        self.long_ids = set() # too long to index, always candidates
+        self.dead = 0
+
+    @staticmethod
+    def trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def follow(self, table):
+        if table is self.table:
+            return
+        old = self.command_by_pid
+        new = {}
+        pids = table.pid
+        metadata = table.metadata
+        for row in range(1, len(table)):
+            pid = pids[row]
+            command = metadata[row].command
+            new[pid] = command
+            old_command = old.get(pid)
+            if old_command != command:
+                if old_command is not None:
+                    self._remove(pid, old_command)
+                self._add(pid, command)
+        for pid, command in old.items():
+            if pid not in new:
+                self._remove(pid, command)
+        self.command_by_pid = new
+        self.table = table
+        if self.dead > max(1000, len(self.entries)):
+            entries = self.entries
+            self._clear()
+            for command, (id, pids) in entries.items():
+                for pid in pids:
+                    self._add(pid, command)
+
+    def _add(self, pid, command):
+        entry = self.entries.get(command)
+        if entry is not None:
+            entry[1].add(pid)
+            return
+        id = len(self.commands)
+        self.commands.append(command)
+        self.entries[command] = [id, {pid}]
+        if len(command) > CommandIndex.MAX_INDEXED_LENGTH:
+            self.long_ids.add(id)
+            return
+        for t in CommandIndex.trigrams(command):
+            ids = self.postings.get(t)
+            if ids is None:
+                self.postings[t] = array('i', [id])
             else:
-                s += tc.vert_not_last
-        if self.this_last:
-            s += tc.this_last
+                ids.append(id)
+
+    def _remove(self, pid, command):
+        entry = self.entries[command]
+        entry[1].discard(pid)
+        if not entry[1]:
+            del self.entries[command]
+            self.commands[entry[0]] = None
+            self.long_ids.discard(entry[0])
+            self.dead += 1
+
+    def pids_containing(self, table, text):
+        """Pids in table whose command contains text, at least 3 characters"""
+        self.follow(table)
+        candidates = None
+        for t in CommandIndex.trigrams(text):
+            ids = self.postings.get(t)
+            if ids is None:
+                candidates = ()
+                break
+            if candidates is None or len(ids) < len(candidates):
+                candidates = ids
+        result = []
+        for ids in (candidates, self.long_ids):
+            for id in ids:
+                command = self.commands[id]
+                if command is not None and text in command:
+                    result.extend(self.entries[command][1])
+        return result
+
+class ProcessFilter:
+    """Finds the rows of a ProcessSnapshot matching the filter fields of the
+    process view. Keeps the last result: when the filter only got more
+    specific on the same snapshot, just the previous matches are tested."""
+    FIELDS = ('UID', 'PID', 'COMMAND')
+
+    def __init__(self, command_index=True):
+        self.command_index = CommandIndex() if command_index else None
+        self.table = None
+        self.matchers = None
+        self.rows = None
+
+    def matching_rows(self, process_snapshot, filter_values):
+        """Matching rows in ascending order, None if the filter is empty"""
+        matchers = {}
+        for field in ProcessFilter.FIELDS:
+            text = filter_values.get(field, "")
+            matchers[field] = FilterMatcher(text) if text else None
+        if not any(matchers.values()):
+            return None
+        table = process_snapshot.table
+        if table is self.table and self._narrows(matchers):
+            candidates = self.rows
         else:
-            s += tc.this_not_last
-        s += self.process_info.comm 
-        return s
+            candidates = self._candidates(table, matchers['COMMAND'])
+        self.rows = self._matching(process_snapshot, candidates, matchers)
+        self.table = table
+        self.matchers = matchers
+        return self.rows
+
+    def _narrows(self, matchers):
+        for field in ProcessFilter.FIELDS:
+            if matchers[field] is None:
+                if self.matchers[field] is not None:
+                    return False
+            elif not matchers[field].narrows(self.matchers[field]):
+                return False
+        return True
+
+    def _candidates(self, table, command_matcher):
+        if self.command_index is None or command_matcher is None or command_matcher.literal is None or len(command_matcher.literal) < 3:
+            return range(len(table))
+        rows = []
+        for pid in self.command_index.pids_containing(table, command_matcher.literal):
+            rows.append(table.find(pid))
+        rows.sort()
+        return rows
+
+    @staticmethod
+    def _matching(process_snapshot, candidates, matchers):
+        uid_matcher = matchers['UID']
+        pid_matcher = matchers['PID']
+        command_matcher = matchers['COMMAND']
+        user_snapshot = process_snapshot.user_snapshot
+        uid_matches = {}
+        pids = process_snapshot.table.pid
+        metadata = process_snapshot.table.metadata
+        rows = []
+        for row in candidates:
+            if command_matcher is not None and not command_matcher.matches(metadata[row].command):
+                continue
+            if pid_matcher is not None and not pid_matcher.matches(str(pids[row])):
+                continue
+            if uid_matcher is not None:
+                uid = metadata[row].uid
+                matched = uid_matches.get(uid)
+                if matched is None:
+                    matched = uid_matches[uid] = uid_matcher.matches(user_snapshot.username(uid))
+                if not matched:
+                    continue
+            rows.append(row)
+        return rows
+
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+PROC_CN_MCAST_LISTEN = 1
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_EXIT = 0x80000000
+# length, type, flags, sequence, port
+NLMSG_HEADER = struct.Struct("=IHHII")
+NLMSG_DONE = 3
+# idx, val, sequence, ack, length, flags
+CN_MSG_HEADER = struct.Struct("=IIIIHH")
+# what, cpu, timestamp, then fork: parent pid, parent tgid, child pid, child tgid
+# exec and exit: pid, tgid, ...
+PROC_EVENT_HEADER = struct.Struct("=IIQ")
+PROC_EVENT_IDS = struct.Struct("=IIII")
+PROC_EVENT_OFFSET = NLMSG_HEADER.size + CN_MSG_HEADER.size
+
+class ExitedProcess:
+    def __init__(self, stat, metadata):
+        self.stat = stat
+        self.metadata = metadata
+
+class ProcConnector(threading.Thread):
+    """Follows fork, exec and exit of processes through the netlink proc
+    connector, so a scan gets the live pids without listing /proc.
+    Processes that exit before any scan saw them are kept with the last
+    /proc/<pid>/stat read when their exit event arrives, short jobs show
+    up at least once. Raises OSError if the socket can't be opened, the
+    connector needs CAP_NET_ADMIN.
+    Lost events (a full socket buffer) and every RESYNC_SCANS scans the
+    pids are listed from /proc again."""
+    RESYNC_SCANS = 60
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, metadata_cache, proc_root=PROC_ROOT):
+        super(ProcConnector, self).__init__(name="jill-proc-events", daemon=True)
+        self.metadata_cache = metadata_cache
+        self.proc_root = proc_root
+        self.reader = ProcReader(ProcFilePool(0, proc_root))
+        self.lock = threading.Lock()
+        self.live = set()
+        self.pids = None # sorted live pids, None after a change
+        self.unscanned = set() # forked and not read by a scan yet
+        self.started = {} # pid -> ExitedProcess as of its exec, for unscanned pids
+        self.exited = {} # pid -> ExitedProcess
+        self.scans = 0
+        self.resync = True
+        self._stop_event = threading.Event()
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ProcConnector.BUFFER_SIZE)
+            self.sock.bind((0, CN_IDX_PROC))
+            op = struct.pack("=I", PROC_CN_MCAST_LISTEN)
+            msg = CN_MSG_HEADER.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(op), 0) + op
+            self.sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(msg), NLMSG_DONE, 0, 0, 0) + msg)
+            # Wakes up now and then to notice close()
+            self.sock.settimeout(1.0)
+        except OSError:
+            self.sock.close()
+            raise
+        self.start()
+
+    def start_scan(self):
+        """The pids to scan and the processes that exited unseen since the last scan"""
+        with self.lock:
+            if self.resync or self.scans % ProcConnector.RESYNC_SCANS == 0:
+                self.live = set(ProcessSnapshot.read_all_pids(self.proc_root))
+                self.pids = None
+                self.resync = False
+                # Their exit events may have been lost
+                self.unscanned &= self.live
+                self.started = dict((pid, p) for pid, p in self.started.items() if pid in self.unscanned)
+            self.scans += 1
+            if self.pids is None:
+                self.pids = sorted(self.live)
+            exited = self.exited
+            self.exited = {}
+            return self.pids, exited
+
+    def finish_scan(self, table):
+        """Forked processes the scan read are no longer kept for their exit,
+        the others may still exit before the next scan sees them"""
+        with self.lock:
+            seen = [pid for pid in self.unscanned if table.find(pid) >= 0]
+            for pid in seen:
+                self.unscanned.discard(pid)
+                self.started.pop(pid, None)
+
+    def close(self):
+        self._stop_event.set()
+        self.join()
+        self.sock.close()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                data = self.sock.recv(ProcConnector.BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    logging.info("Process events lost, listing {} again".format(self.proc_root))
+                    with self.lock:
+                        self.resync = True
+                    continue
+                logging.error(traceback.format_exc())
+                return
+            offset = 0
+            while offset + PROC_EVENT_OFFSET + PROC_EVENT_HEADER.size + PROC_EVENT_IDS.size <= len(data):
+                length = NLMSG_HEADER.unpack_from(data, offset)[0]
+                if length == 0:
+                    break
+                try:
+                    self._handle(data, offset + PROC_EVENT_OFFSET)
+                except Exception:
+                    logging.error(traceback.format_exc())
+                offset += (length + 3) & ~3
+
+    def _handle(self, data, offset):
+        what = PROC_EVENT_HEADER.unpack_from(data, offset)[0]
+        ids = PROC_EVENT_IDS.unpack_from(data, offset + PROC_EVENT_HEADER.size)
+        if what == PROC_EVENT_FORK:
+            parent_pid, parent_tgid, pid, tgid = ids
+            if pid == tgid: # not a new thread
+                with self.lock:
+                    self.live.add(pid)
+                    self.unscanned.add(pid)
+                    self.pids = None
+        elif what == PROC_EVENT_EXEC:
+            pid = ids[0]
+            stat = self.reader.read_stat(pid)
+            if stat:
+                self.metadata_cache.invalidate(pid, stat[8])
+                if pid in self.unscanned:
+                    # The command line is only there until the process exits
+                    metadata = self.metadata_cache.get(self.reader, pid, stat[8], stat[1])
+                    if metadata:
+                        with self.lock:
+                            self.started[pid] = ExitedProcess(stat, metadata)
+        elif what == PROC_EVENT_EXIT:
+            pid, tgid = ids[0], ids[1]
+            if pid == tgid:
+                exited = None
+                if pid in self.unscanned:
+                    # Its parent may have reaped it already, then it's the stat of the exec
+                    exited = self._read(pid) or self.started.get(pid)
+                with self.lock:
+                    self.live.discard(pid)
+                    self.pids = None
+                    self.unscanned.discard(pid)
+                    self.started.pop(pid, None)
+                    if exited:
+                        self.exited[pid] = exited
+
+    def _read(self, pid):
+        """pid's stat and metadata, None if it's already gone"""
+        stat = self.reader.read_stat(pid)
+        if stat is None:
+            return None
+        metadata = self.metadata_cache.get(self.reader, pid, stat[8], stat[1])
+        if metadata is None:
+            return None
+        return ExitedProcess(stat, metadata)
+
+class ProcessScanner:
+    """Reads all processes into a ProcessTable, either serially or split over
+    a pool of worker threads. The pids are dealt out as pid % workers, so a
+    pid stays with the same worker and its open files in the same pool from
+    tick to tick."""
+    def __init__(self, metadata_cache, max_open_files, workers=1, proc_root=PROC_ROOT, process_events=False):
+        self.metadata_cache = metadata_cache
+        self.workers = max(1, workers)
+        self.proc_root = proc_root
+        # The io files have a budget of their own, they'd evict stat and status
+        raise_open_file_limit(2 * max_open_files)
+        self.proc_files = [ProcFilePool(max_open_files // self.workers, proc_root) for i in range(self.workers)]
+        self.io_files = ProcFilePool(max_open_files, proc_root)
+        if self.workers > 1:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="jill-scan")
+        else:
+            self.executor = None
+        self.io_denied = set() # (pid, starttime) of processes whose io can't be read
+        self.connector = None
+        if process_events:
+            try:
+                self.connector = ProcConnector(metadata_cache, proc_root)
+            except OSError as e:
+                logging.info("No process events ({}), listing {} every scan".format(e, proc_root))
+
+    def scan(self, uptime):
+        """Only /proc/<pid>/stat is read for processes already in the
+        metadata cache, everything else doesn't change over their lifetime.
+        Row 0 of the result is the artificial process 0 all trees hang from."""
+        if self.connector:
+            pids, exited = self.connector.start_scan()
+        else:
+            pids, exited = ProcessSnapshot.read_all_pids(self.proc_root), {}
+        live_pids = set(pids)
+        live_pids.update(exited)
+        self.metadata_cache.start_scan(live_pids)
+        for proc_files in self.proc_files:
+            proc_files.start_scan(live_pids)
+        self.io_files.start_scan(live_pids)
+        table = ProcessTable(uptime, self.proc_root)
+        table.append(0, -1, ord('0'), 0, 0, 0, 0, 0, 0, ROOT_METADATA)
+        if self.executor is None:
+            self._scan_pids(pids, self.proc_files[0], table)
+            tables = [table]
+        else:
+            chunks = [[] for i in range(self.workers)]
+            for pid in pids:
+                chunks[pid % self.workers].append(pid)
+            futures = []
+            for chunk, proc_files in zip(chunks, self.proc_files):
+                futures.append(self.executor.submit(self._scan_pids, chunk, proc_files, ProcessTable(uptime, self.proc_root)))
+            tables = [table] + [f.result() for f in futures]
+        if exited:
+            tables.append(ProcessScanner._exited_table(uptime, exited, tables))
+        table = tables[0] if len(tables) == 1 else ProcessTable.merged(uptime, tables)
+        if self.connector:
+            self.connector.finish_scan(table)
+        return table
+
+    @staticmethod
+    def _exited_table(uptime, exited, tables):
+        """Processes that came and went between two scans, as dead ones.
+        Their pids may be in use again already."""
+        table = ProcessTable(uptime, tables[0].proc_root)
+        for pid in sorted(exited):
+            if any(t.find(pid) >= 0 for t in tables):
+                continue
+            p = exited[pid]
+            stat_pid, comm, state, ppid, utime, stime, cutime, cstime, starttime, vsize = p.stat
+            table.append(pid, ppid, ord('X'), utime, stime, cutime, cstime, starttime, vsize, p.metadata)
+        return table
+
+    def scan_io(self, table):
+        """read_bytes and write_bytes of every row of table, -1 where
+        /proc/<pid>/io can't be read. Without permission for a process it's
+        not tried again as long as the process lives."""
+        read_bytes = array('q', [-1]) * len(table)
+        write_bytes = array('q', [-1]) * len(table)
+        denied = set()
+        reader = ProcReader(self.io_files)
+        for row in range(1, len(table)):
+            pid = table.pid[row]
+            key = (pid, table.starttime[row])
+            if key in self.io_denied:
+                denied.add(key)
+                continue
+            try:
+                io = reader.read_io(pid)
+            except PermissionError:
+                denied.add(key)
+                continue
+            if io is not None:
+                read_bytes[row], write_bytes[row] = io
+        # Only keys of processes still there
+        self.io_denied = denied
+        return read_bytes, write_bytes
+
+    def close_io(self):
+        """While the I/O columns are hidden no io file is kept open"""
+        self.io_files.close_all()
+        self.io_denied = set()
+
+    def scan_threads(self, pid, uid, uptime):
+        """The threads of pid from /proc/<pid>/task, None if it's gone"""
+        task_dir = "%s/%d/task" % (self.proc_root, pid)
+        try:
+            tids = sorted(int(t) for t in os.listdir(task_dir))
+        except OSError:
+            return None
+        table = ProcessTable(uptime, self.proc_root)
+        for tid in tids:
+            try:
+                with open("%s/%d/stat" % (task_dir, tid), 'rb') as f:
+                    buf = f.read()
+            except OSError:
+                # Ended since the listing
+                continue
+            stat_tid, comm, state, ppid, utime, stime, cutime, cstime, starttime, vsize = parse_stat(buf, len(buf))
+            name = comm.decode(errors='replace')
+            table.append(tid, pid, state, utime, stime, cutime, cstime, starttime, vsize, ProcessMetadata("{%s}" % name, name, uid, None))
+        return table
+
+    def close(self):
+        if self.connector:
+            self.connector.close()
+
+    def _scan_pids(self, pids, proc_files, table):
+        proc_reader = ProcReader(proc_files)
+        for pid in pids:
+            p = proc_reader.read_stat(pid)
+            if p:
+                stat_pid, comm, state, ppid, utime, stime, cutime, cstime, starttime, vsize = p
+                if pid != stat_pid:
+                    raise Exception("Nasty inconsistency for %d: %s" % (pid, stat_pid))
+                metadata = self.metadata_cache.get(proc_reader, pid, starttime, comm)
+                if metadata is None:
+                    continue
+                table.append(pid, ppid, state, utime, stime, cutime, cstime, starttime, vsize, metadata)
+        return table
 
 
 class ProcessSnapshot:
-    def __init__(self, selinux_enabled, user_snapshot, uptime, command_cache):
+    def __init__(self, selinux_enabled, user_snapshot, uptime, scanner, expanded_pids=(), read_io=False):
         self.selinux_enabled = selinux_enabled
         self.user_snapshot = user_snapshot
         self.uptime = uptime
-        self.command_cache = command_cache
+        self.table = scanner.scan(self.uptime)
+        # (read_bytes, write_bytes) aligned with the rows, only while the I/O columns are shown
+        self.io = scanner.scan_io(self.table) if read_io else None
+        # Only the processes expanded in the view get their tasks read, pid -> ProcessTable
+        self.threads = {}
+        for pid in expanded_pids:
+            row = self.table.find(pid)
+            if row >= 0:
+                threads = scanner.scan_threads(pid, self.table.metadata[row].uid, self.uptime)
+                if threads is not None:
+                    self.threads[pid] = threads
+        self.root = ProcessInfo(self.table, 0)
+        self.max_pid = self.table.pid[len(self.table) - 1]
+        # Link the complete tree once, filtering happens in get_process_lines
+        self.children = {} # row -> rows of its children
+        self.parent_row = array('i', [-1]) * len(self.table)
+        ppids = self.table.ppid
+        for row in range(1, len(self.table)):
+            parent_row = self.table.find(ppids[row])
+            if parent_row >= 0:
+                self.parent_row[row] = parent_row
+                if parent_row in self.children:
+                    self.children[parent_row].append(row)
+                else:
+                    self.children[parent_row] = [row]
+
+    def get_process_info(self, pid):
+        row = self.table.find(pid)
+        return ProcessInfo(self.table, row) if row >= 0 else None
 
+    def get_thread_info(self, pid, tid):
+        """Thread tid of pid, only for expanded processes"""
+        threads = self.threads.get(pid)
+        row = threads.find(tid) if threads is not None else -1
+        return ProcessInfo(threads, row) if row >= 0 else None
 
     @staticmethod
-    def read_all_pids():
+    def read_all_pids(proc_root=PROC_ROOT):
         pids = []
-        for l in os.listdir("/proc"):
+        for l in os.listdir(proc_root):
             if l.isnumeric():
                 pids.append(int(l))
+        # Already sorted the way /proc lists them, so this costs a single pass
+        pids.sort()
         return pids
 
-    @staticmethod
-    def _split_process_info_line(line):
-        try:
-            split1 = line.split("(" * line.count("("))
-            before = split1[0][:-1]
-            split2 = split1[1].split(")" * line.count("("))
-            mid = split2[0]
-            after = split2[1][1:]
-            result = before.split(" ") + [mid] + after.split(" ")
-            return result
-        except:
-            raise Exception(line)
-
-    @staticmethod
-    def _read_process_info_list(selinux_enabled, uptime, command_cache, filter):
-        result =  []
-        vsize_sum = 0
-        for pid in ProcessSnapshot.read_all_pids():
-            line = read_single_line("/proc/%d/stat" % pid)
-            if line:
-                p = ProcessSnapshot._split_process_info_line(line)
-                if pid != int(p[0]):
-                    raise Exception("Nasty inconsistency for %d: %s" % (pid, p[0]))
-                command_line = command_cache.get_command(pid)
-                starttime = float(p[21])
-                #starttime = (time.time() - uptime) + float(float(p[21]) /  CLOCK_TICKS)
-                uid = -1
-                with open("/proc/%d/status" % pid, 'r') as f:
-                    for l in f.read().splitlines():
-                        if l.startswith("Uid:"):
-                            parts = l.split("\t")
-                            uid = int(parts[1])
-                result.append(ProcessInfo(
-                    selinux_enabled,
-                    uptime,
-                    uid,
-                    pid,
-                    p[2],
-                    int(p[3]),
-                    command_line,
-                    int(p[12]),
-                    int(p[13]),
-                    int(p[14]),
-                    int(p[15]),
-                    starttime,
-                    int(p[22])
-                ))
-                vsize_sum += int(p[22])
-        return result
-    @staticmethod
-    def get_all_descendants(process_info):
-        children = []
-        for c in process_info.children:
-            children.append(c)
-            children.extend(ProcessSnapshot.get_all_descendants(c))
-        return children
-		
-    def get_all_descendant_pis(self, pi):
-        children = []
-        for c in self.process_list:
-            if c.ppid == pi.pid:
-                children.append(c)
-                children.extend(self.get_all_descendant_pis(c))
-        return children
-    @staticmethod
-    def _add_lines(user_snapshot, process_delta, max_pid, lines, parents_last, this_last, node, pids_to_show):
-        if node.pid not in pids_to_show:
-            #logging.info("OOOPS {} is not in {}".format(node.pid, pids_to_show))
-            return
-        lines.append(ProcessTreeLine(user_snapshot, process_delta, max_pid, node, parents_last, this_last))
-        for i in range(0, len(node.children)):
-            c = node.children[i]
-            this_child_last = (i == len(node.children) - 1)
-            new_parents_last = []
-            new_parents_last.extend(parents_last)
-            new_parents_last.append(this_last)
-            ProcessSnapshot._add_lines(user_snapshot, process_delta, max_pid, lines, new_parents_last, this_child_last, c, pids_to_show)
-
-    @staticmethod
-    def matches_info(user_snapshot, process_info, filter_values):
-        username = user_snapshot.username_by_uid[process_info.uid]
-        if filter_values['UID'] not in username:
-            return False
-        if filter_values['PID'] not in str(process_info.pid):
-            return False
-        if filter_values['COMMAND'] not in process_info.comm:
-            return False
-        return True
-
-    @staticmethod
-    def matches(actual_values, filter_values):
-        for filter_key in filter_values:
-            filter_value = filter_values[filter_key]
-            if filter_value:
-                if filter_value not in actual_values[filter_key]:
-                    return False
-        return True
-
-    def get_process_lines(self, process_delta, filter = {}):
-        self.root = ProcessInfo(self.selinux_enabled, self.uptime, 0, 0, '0', None, "Root", 0, 0, 0, 0, 0, 0)
-        self.max_pid = 0
-        self.process_list = [self.root]
-        self.process_list.extend(ProcessSnapshot._read_process_info_list(self.selinux_enabled, self.uptime, self.command_cache, filter))
-        self.process_info_by_pid = {}
-        for p in self.process_list:
-            if p.pid > self.max_pid:
-                self.max_pid = p.pid
-            self.process_info_by_pid[p.pid] = p
-
-        pids_to_show = set()
-        pids_to_show.add(0)
-        for pi in self.process_list:
-            if ProcessSnapshot.matches_info(self.user_snapshot, pi, filter):
-                up = pi
-                while up is not None and up != self.root:
-                    pids_to_show.add(up.pid)
-                    up = self.process_info_by_pid[up.ppid]
-                for pic in self.get_all_descendant_pis(pi):
-                    pids_to_show.add(pic.pid)
-
-
-        for p in self.process_list:
-            if not(p.ppid is None) and p.pid in pids_to_show:
-                self.process_info_by_pid[p.ppid].children.append(p)
-                p.parent = self.process_info_by_pid[p.ppid]
-
+    def get_rows_to_show(self, matching_rows):
+        """One flag per row: set for the matching rows, their ancestors and
+        their descendants. Every row is visited a bounded number of times, no
+        matter how many of them match. None matches all rows."""
+        count = len(self.table)
+        if matching_rows is None:
+            return bytearray(b'\x01') * count
+        shown = bytearray(count)
+        expanded = bytearray(count) # the whole subtree is already shown
+        shown[0] = 1
+        for row in matching_rows:
+            if not expanded[row]:
+                stack = [row]
+                while stack:
+                    r = stack.pop()
+                    shown[r] = 1
+                    expanded[r] = 1
+                    for c in self.children.get(r, ()):
+                        if not expanded[c]:
+                            stack.append(c)
+            # A shown row always has all its ancestors shown, so stop there
+            up = self.parent_row[row]
+            while up > 0 and not shown[up]:
+                shown[up] = 1
+                up = self.parent_row[up]
+        return shown
+
+    def get_process_lines(self, process_delta, filter = {}, process_filter = None):
+        if process_filter is None:
+            process_filter = ProcessFilter(command_index=False)
+        rows_to_show = self.get_rows_to_show(process_filter.matching_rows(self, filter))
+        tc = TREE_CHARS
         lines = []
-        ProcessSnapshot._add_lines(self.user_snapshot, process_delta, self.max_pid, lines, [], True, self.root, pids_to_show)
-        lines_by_pid = {}
-        for l in lines:
-            pid = l.values['PID']
-            lines_by_pid[pid] = l
-
+        # (row, indent, last sibling, prefix). Siblings share their indent and
+        # their prefix strings, so each is built once per parent, not per line.
+        stack = [(0, "", True, tc.this_last)]
+        while stack:
+            row, indent, last, prefix = stack.pop()
+            lines.append(ProcessTreeLine(self.user_snapshot, process_delta, self.max_pid, ProcessInfo(self.table, row), prefix))
+            children = [c for c in self.children.get(row, ()) if rows_to_show[c]]
+            threads = self.threads.get(self.table.pid[row]) if self.threads else None
+            if children or threads:
+                indent += tc.vert_last if last else tc.vert_not_last
+            if threads:
+                # Above the child processes
+                for t in range(len(threads)):
+                    thread_prefix = indent + (tc.this_last if t == len(threads) - 1 and not children else tc.this_not_last)
+                    lines.append(ThreadTreeLine(self.user_snapshot, process_delta, self.max_pid, ProcessInfo(threads, t), thread_prefix))
+            if children:
+                stack.append((children[-1], indent, True, indent + tc.this_last))
+                prefix_not_last = indent + tc.this_not_last
+                for i in range(len(children) - 2, -1, -1):
+                    stack.append((children[i], indent, False, prefix_not_last))
         return lines
 
 class Snapshot:
-    def __init__(self, selinux_enabled, user_snapshot, command_cache):
-        self.cpu_snapshot = CpuSnapshot()
-        self.process_snapshot = ProcessSnapshot(selinux_enabled, user_snapshot, self.cpu_snapshot.uptime, command_cache)
+    """The latest CPU and process snapshots, each collected on its own schedule"""
+    def __init__(self, cpu_snapshot, process_snapshot):
+        self.cpu_snapshot = cpu_snapshot
+        self.process_snapshot = process_snapshot
 
 
 class CpuDelta:
@@ -590,68 +1791,973 @@ class SingleProcessDelta:
         self.cstime = cstime
 
 class ProcessDelta:
+    """CPU usage of all processes, computed for the whole table at once.
+    Rows of both snapshots are aligned by pid; a pid that's new or was
+    reused by another process (different starttime) counts as 0%."""
     def __init__(self, process_snapshot1, process_snapshot2):
         self.process_snapshot1 = process_snapshot1
         self.process_snapshot2 = process_snapshot2
+        table1 = process_snapshot1.table
+        table2 = process_snapshot2.table
+        seconds = table2.uptime - table1.uptime
+        if seconds > 0:
+            factor = 100.0 / CLOCK_TICKS / seconds
+        else:
+            factor = 0.0
+        if numpy is not None:
+            self.cpu_percentages = ProcessDelta._cpu_percentages_numpy(table1, table2, factor)
+        else:
+            self.cpu_percentages = ProcessDelta._cpu_percentages(table1, table2, factor)
+        self.io_rates = ProcessDelta._io_rates(process_snapshot1, process_snapshot2, seconds)
+        # The same for the threads of expanded processes, 0% on the first tick after expanding
+        self.thread_cpu_percentages = {}
+        for pid, threads2 in process_snapshot2.threads.items():
+            threads1 = process_snapshot1.threads.get(pid)
+            if threads1 is None:
+                threads1 = ProcessTable(table1.uptime)
+            self.thread_cpu_percentages[pid] = ProcessDelta._cpu_percentages(threads1, threads2, factor)
+
+    @staticmethod
+    def _aligned_rows(table1, table2):
+        """For every row of table2 the row of the same process in table1, or -1"""
+        rows = array('i', [-1]) * len(table2)
+        pids1 = table1.pid
+        starttimes1 = table1.starttime
+        starttimes2 = table2.starttime
+        count1 = len(pids1)
+        row1 = 0
+        for row2, pid in enumerate(table2.pid):
+            while row1 < count1 and pids1[row1] < pid:
+                row1 += 1
+            if row1 < count1 and pids1[row1] == pid and starttimes1[row1] == starttimes2[row2]:
+                rows[row2] = row1
+        return rows
+
+    @staticmethod
+    def _io_rates(process_snapshot1, process_snapshot2, seconds):
+        """Bytes read and written per second, -1 where it's not known. None
+        unless both snapshots have I/O counters."""
+        if process_snapshot1.io is None or process_snapshot2.io is None or seconds <= 0:
+            return None
+        rows = ProcessDelta._aligned_rows(process_snapshot1.table, process_snapshot2.table)
+        count = len(process_snapshot2.table)
+        rates = (array('d', [-1.0]) * count, array('d', [-1.0]) * count)
+        for counters1, counters2, rate in zip(process_snapshot1.io, process_snapshot2.io, rates):
+            for row2, row1 in enumerate(rows):
+                if row1 >= 0 and counters1[row1] >= 0 and counters2[row2] >= 0:
+                    rate[row2] = (counters2[row2] - counters1[row1]) / seconds
+        return rates
+
+    @staticmethod
+    def _cpu_percentages(table1, table2, factor):
+        rows = ProcessDelta._aligned_rows(table1, table2)
+        utime1, stime1 = table1.utime, table1.stime
+        utime2, stime2 = table2.utime, table2.stime
+        result = array('d', bytes(8 * len(table2)))
+        for row2, row1 in enumerate(rows):
+            if row1 >= 0:
+                result[row2] = (utime2[row2] + stime2[row2] - utime1[row1] - stime1[row1]) * factor
+        return result
+
+    @staticmethod
+    def _cpu_percentages_numpy(table1, table2, factor):
+        pids1 = numpy.frombuffer(table1.pid, dtype=numpy.intc)
+        pids2 = numpy.frombuffer(table2.pid, dtype=numpy.intc)
+        if len(pids1) == 0 or len(pids2) == 0:
+            return numpy.zeros(len(pids2))
+        rows = numpy.minimum(numpy.searchsorted(pids1, pids2), len(pids1) - 1)
+        starttimes1 = numpy.frombuffer(table1.starttime, dtype=numpy.int64)
+        starttimes2 = numpy.frombuffer(table2.starttime, dtype=numpy.int64)
+        same = (pids1[rows] == pids2) & (starttimes1[rows] == starttimes2)
+        total1 = numpy.frombuffer(table1.utime, dtype=numpy.int64) + numpy.frombuffer(table1.stime, dtype=numpy.int64)
+        total2 = numpy.frombuffer(table2.utime, dtype=numpy.int64) + numpy.frombuffer(table2.stime, dtype=numpy.int64)
+        return numpy.where(same, (total2 - total1[rows]) * factor, 0.0)
 
     def get_single_process_delta(self, pid):
-        pi1 = self.process_snapshot1.process_info_by_pid[pid]
-        pi2 = self.process_snapshot2.process_info_by_pid[pid]
-        if pi1 and pi2:
-            du = pi2.utime - pi1.utime
-            ds = pi2.stime - pi1.stime
-            cu = pi2.cutime - pi1.cutime
-            cs = pi2.cstime - pi1.cstime
+        return ProcessDelta._single_delta(self.process_snapshot1.table, self.process_snapshot2.table, pid)
+
+    def get_single_thread_delta(self, pid, tid):
+        threads1 = self.process_snapshot1.threads.get(pid)
+        threads2 = self.process_snapshot2.threads.get(pid)
+        if threads1 is None or threads2 is None:
+            return None
+        return ProcessDelta._single_delta(threads1, threads2, tid)
+
+    @staticmethod
+    def _single_delta(table1, table2, pid):
+        row1 = table1.find(pid)
+        row2 = table2.find(pid)
+        if row1 >= 0 and row2 >= 0 and table1.starttime[row1] == table2.starttime[row2]:
+            du = table2.utime[row2] - table1.utime[row1]
+            ds = table2.stime[row2] - table1.stime[row1]
+            cu = table2.cutime[row2] - table1.cutime[row1]
+            cs = table2.cstime[row2] - table1.cstime[row1]
             return SingleProcessDelta(du, ds, cu, cs)
         else:
             return None
 
     def cpu_usage(self, pid):
-        try:
-            info1 = self.process_snapshot1.process_info_by_pid[pid]
-            info2 = self.process_snapshot2.process_info_by_pid[pid]
-        except:
-            logging.error(traceback.format_exc())
+        row = self.process_snapshot2.table.find(pid)
+        if row < 0:
             return 0
-        
+        return self.cpu_percentages[row]
 
-        total_time_1 = info1.utime + info1.stime
-        total_time_2 = info2.utime + info2.stime
-        delta_total = total_time_2 - total_time_1
-        seconds = info2.uptime - info1.uptime
-        cpu_usage = 100.0 * ((delta_total / CLOCK_TICKS) / seconds)
-        return cpu_usage
+    def io_rate(self, pid):
+        """(read, write) bytes per second, None if not known"""
+        row = self.process_snapshot2.table.find(pid)
+        if self.io_rates is None or row < 0 or self.io_rates[0][row] < 0:
+            return None
+        return self.io_rates[0][row], self.io_rates[1][row]
+
+    def thread_cpu_usage(self, pid, tid):
+        threads = self.process_snapshot2.threads.get(pid)
+        row = threads.find(tid) if threads is not None else -1
+        if row < 0:
+            return 0
+        return self.thread_cpu_percentages[pid][row]
 
 class Delta:
-    def __init__(self, snapshot1, snapshot2):
-        self.cpu_delta = CpuDelta(snapshot1.cpu_snapshot, snapshot2.cpu_snapshot)
-        self.process_delta = ProcessDelta(snapshot1.process_snapshot, snapshot2.process_snapshot)
+    def __init__(self, cpu_delta, process_delta):
+        self.cpu_delta = cpu_delta
+        self.process_delta = process_delta
+
+
+class PowerState:
+    def __init__(self, power_info):
+        self.status = power_info.status
+        self.capacity = power_info.capacity
+        self.time_remaining_str = power_info.time_remaining_str
+
+class Collector:
+    """One kind of data JillModel collects, every interval seconds"""
+    def __init__(self, name, interval, collect):
+        self.name = name
+        self.interval = interval
+        self.collect = collect
+        self.next_due = 0.0
+        self.runs = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+
+    def average_duration(self):
+        return self.total_duration / self.runs if self.runs else 0.0
+
+class CollectorTiming:
+    def __init__(self, collector):
+        self.name = collector.name
+        self.interval = collector.interval
+        self.runs = collector.runs
+        self.last_duration = collector.last_duration
+        self.average_duration = collector.average_duration()
+
+class CollectorScheduler:
+    """Runs each collector when its interval is over. It's asked on every
+    tick of the Sampler, so intervals shorter than that are rounded up."""
+    # Ticks may come a little early, still count them as on time
+    SLACK = 0.05
+
+    def __init__(self, collectors):
+        self.collectors = collectors
+
+    def run_due(self, now):
+        """Runs the collectors that are due, returns their names"""
+        ran = []
+        for c in self.collectors:
+            if now + CollectorScheduler.SLACK < c.next_due:
+                continue
+            start = time.monotonic_ns()
+            try:
+                c.collect()
+            except Exception:
+                # Keeps the data of the last run, the others still run
+                logging.error(traceback.format_exc())
+            elapsed = time.monotonic_ns() - start
+            if PHASE_TIMINGS.enabled:
+                PHASE_TIMINGS.add("collect." + c.name, elapsed)
+            c.last_duration = elapsed / 1e9
+            c.total_duration += c.last_duration
+            c.runs += 1
+            c.next_due += c.interval
+            if c.next_due <= now:
+                # Behind schedule, don't try to catch up
+                c.next_due = now + c.interval
+            ran.append(c.name)
+        return ran
+
+    def timings(self):
+        return [CollectorTiming(c) for c in self.collectors]
+
+FLIGHT_MAGIC = b"JILLFR01"
+# magic, capacity, head, tail, count
+FLIGHT_HEADER = struct.Struct("=8sQQQQ")
+FLIGHT_HEADER_SIZE = 4096
+# length, kind, flags, wall clock time, CPU uptime, process uptime
+FLIGHT_RECORD = struct.Struct("=IBBxxddd")
+FLIGHT_BLOB = struct.Struct("=I")
+
+FLIGHT_WRAP = 0
+FLIGHT_KEYFRAME = 1
+FLIGHT_DELTA = 2
+
+# Flags, set if the collector didn't run since the tick before
+FLIGHT_SAME_CPU = 1
+FLIGHT_SAME_PROCESSES = 2
+FLIGHT_SAME_MEM = 4
+
+# Columns of new processes and the ones that change over their lifetime
+FLIGHT_NEW_COLUMNS = 10
+FLIGHT_CHANGED_COLUMNS = 7
+
+def pack_blobs(blobs):
+    parts = []
+    for blob in blobs:
+        parts.append(FLIGHT_BLOB.pack(len(blob)))
+        parts.append(blob)
+    return b"".join(parts)
+
+def unpack_blobs(data):
+    blobs = []
+    offset = 0
+    while offset < len(data):
+        size = FLIGHT_BLOB.unpack_from(data, offset)[0]
+        offset += FLIGHT_BLOB.size
+        blobs.append(data[offset:offset + size])
+        offset += size
+    return blobs
+
+class FlightRing:
+    """Records of variable length in a memory mapped file of fixed size.
+    Once it's full the oldest records are overwritten. A record never
+    wraps around the end, a wrap record marks where the next lap starts.
+    Without capacity an existing file is opened read only."""
+    def __init__(self, path, capacity=None):
+        self.writable = capacity is not None
+        if capacity is None:
+            self.file = open(path, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self.map) < FLIGHT_HEADER_SIZE:
+                raise Exception("Not a flight recording: %s" % path)
+            magic, self.capacity, self.head, self.tail, self.count = FLIGHT_HEADER.unpack_from(self.map)
+            if magic != FLIGHT_MAGIC or len(self.map) != FLIGHT_HEADER_SIZE + self.capacity:
+                raise Exception("Not a flight recording: %s" % path)
+            return
+        self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+        size = FLIGHT_HEADER_SIZE + capacity
+        self.file.seek(0)
+        header = self.file.read(FLIGHT_HEADER.size)
+        if len(header) == FLIGHT_HEADER.size and os.fstat(self.file.fileno()).st_size == size:
+            magic, old_capacity, head, tail, count = FLIGHT_HEADER.unpack(header)
+        else:
+            magic = None
+        self.map = None
+        if magic == FLIGHT_MAGIC and old_capacity == capacity:
+            # Goes on after the records of the last run
+            self.capacity, self.head, self.tail, self.count = capacity, head, tail, count
+        else:
+            self.file.truncate(0)
+            self.file.truncate(size)
+            self.capacity, self.head, self.tail, self.count = capacity, 0, 0, 0
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self._write_header()
+
+    def __len__(self):
+        return self.count
+
+    def _write_header(self):
+        FLIGHT_HEADER.pack_into(self.map, 0, FLIGHT_MAGIC, self.capacity, self.head, self.tail, self.count)
+
+    def _next(self, offset):
+        """Offset of the record after the one at offset"""
+        offset += FLIGHT_RECORD.unpack_from(self.map, FLIGHT_HEADER_SIZE + offset)[0]
+        if self.capacity - offset < FLIGHT_RECORD.size or self.kind(offset) == FLIGHT_WRAP:
+            return 0
+        return offset
 
+    def _drop_records(self, start, end):
+        """Drops the oldest records while they start in [start, end)"""
+        while self.count > 0 and start <= self.tail < end:
+            self.tail = self._next(self.tail)
+            self.count -= 1
 
-class JillModel:
+    def append(self, record):
+        size = len(record)
+        if size > self.capacity:
+            return False
+        if self.head + size > self.capacity:
+            self._drop_records(self.head, self.capacity)
+            if self.capacity - self.head >= FLIGHT_RECORD.size:
+                FLIGHT_RECORD.pack_into(self.map, FLIGHT_HEADER_SIZE + self.head, FLIGHT_RECORD.size, FLIGHT_WRAP, 0, 0.0, 0.0, 0.0)
+            self.head = 0
+        self._drop_records(self.head, self.head + size)
+        if self.count == 0:
+            self.tail = self.head
+        start = FLIGHT_HEADER_SIZE + self.head
+        self.map[start:start + size] = record
+        self.head += size
+        self.count += 1
+        self._write_header()
+        return True
+
+    def kind(self, offset):
+        return self.map[FLIGHT_HEADER_SIZE + offset + 4]
+
+    def offsets(self):
+        """Offsets of all records, oldest first"""
+        offset = self.tail
+        for i in range(self.count):
+            yield offset
+            offset = self._next(offset)
+
+    def read(self, offset):
+        start = FLIGHT_HEADER_SIZE + offset
+        size = FLIGHT_RECORD.unpack_from(self.map, start)[0]
+        return self.map[start:start + size]
+
+    def close(self):
+        if self.map is not None:
+            if self.writable:
+                self.map.flush()
+            self.map.close()
+        self.file.close()
+
+class FlightEncoder:
+    """Encodes a tick as the differences to the tick encoded before it, or
+    completely for a keyframe. Processes are aligned by pid and starttime,
+    only new and gone processes and the counters that changed are kept."""
     def __init__(self):
-        self.delta = None
-        self.selinux_info = SELinuxInfo()
-        self.command_cache = CommandCache()
-        self.battery_paths = find_battery_paths()
-        self.thermal_info = ThermalInfo()
-        user_snapshot = UserSnapshot()
-        self.snapshot = Snapshot(self.selinux_info(), user_snapshot, self.command_cache)
-        self.mem_info_snapshot = MemInfoSnapshot()
+        self.cpu_snapshot = None
+        self.cpu_counters = None
+        self.mem_info_snapshot = None
+        self.table = None
+
+    def encode(self, wall_time, cpu_snapshot, table, mem_info_snapshot, keyframe):
+        counters = cpu_counters(cpu_snapshot)
+        if self.table is None or len(counters) != len(self.cpu_counters):
+            # Nothing to refer to, or CPUs went on- or offline
+            keyframe = True
+        flags = 0
+        if cpu_snapshot is self.cpu_snapshot:
+            flags |= FLIGHT_SAME_CPU
+        if table is self.table:
+            flags |= FLIGHT_SAME_PROCESSES
+        if mem_info_snapshot is self.mem_info_snapshot:
+            flags |= FLIGHT_SAME_MEM
+        if keyframe:
+            blobs = [counters.tobytes(), FlightEncoder._encode_mem(mem_info_snapshot.values, {})]
+            blobs += FlightEncoder._encode_processes(None, table)
+        else:
+            if flags & FLIGHT_SAME_CPU:
+                blobs = [b""]
+            else:
+                blobs = [array('q', [c - p for c, p in zip(counters, self.cpu_counters)]).tobytes()]
+            if flags & FLIGHT_SAME_MEM:
+                blobs.append(b"")
+            else:
+                blobs.append(FlightEncoder._encode_mem(mem_info_snapshot.values, self.mem_info_snapshot.values))
+            if flags & FLIGHT_SAME_PROCESSES:
+                blobs += [b""] * 5
+            else:
+                blobs += FlightEncoder._encode_processes(self.table, table)
+        self.cpu_snapshot = cpu_snapshot
+        self.cpu_counters = counters
+        self.mem_info_snapshot = mem_info_snapshot
+        self.table = table
+        payload = zlib.compress(pack_blobs(blobs), 1)
+        header = FLIGHT_RECORD.pack(FLIGHT_RECORD.size + len(payload), FLIGHT_KEYFRAME if keyframe else FLIGHT_DELTA, flags,
+                                    wall_time, cpu_snapshot.uptime, table.uptime)
+        return header + payload
+
+    @staticmethod
+    def _encode_mem(values, previous_values):
+        changed = []
+        for key, value in values.items():
+            if previous_values.get(key) != value:
+                changed.append(key)
+                changed.append(value)
+        return "\0".join(changed).encode()
+
+    @staticmethod
+    def _encode_processes(previous, table):
+        """Blobs of the gone pids, the columns and the commands of the new
+        processes, the pids of the changed ones and their differences"""
+        gone = array('i')
+        changed_pids = array('i')
+        changed = [array('q') for i in range(FLIGHT_CHANGED_COLUMNS)]
+        if previous is None:
+            new_rows = range(len(table))
+        else:
+            new_rows = []
+            matched = bytearray(len(previous))
+            columns1 = (previous.ppid, previous.state, previous.utime, previous.stime, previous.cutime, previous.cstime, previous.vsize)
+            columns2 = (table.ppid, table.state, table.utime, table.stime, table.cutime, table.cstime, table.vsize)
+            utime1, stime1, utime2, stime2 = previous.utime, previous.stime, table.utime, table.stime
+            for row2, row1 in enumerate(ProcessDelta._aligned_rows(previous, table)):
+                if row1 < 0:
+                    new_rows.append(row2)
+                    continue
+                matched[row1] = 1
+                # Most of the changes are CPU time, compare that first
+                if utime1[row1] == utime2[row2] and stime1[row1] == stime2[row2]:
+                    if all(c1[row1] == c2[row2] for c1, c2 in zip(columns1, columns2)):
+                        continue
+                changed_pids.append(table.pid[row2])
+                for column, c1, c2 in zip(changed, columns1, columns2):
+                    column.append(c2[row2] - c1[row1])
+            gone.extend(pid for pid, m in zip(previous.pid, matched) if not m)
+        new = array('q')
+        for column in (table.pid, table.ppid, table.state, table.utime, table.stime, table.cutime, table.cstime, table.starttime, table.vsize):
+            new.extend(column[row] for row in new_rows)
+        new.extend(table.metadata[row].uid for row in new_rows)
+        commands = []
+        for row in new_rows:
+            metadata = table.metadata[row]
+            commands.append(metadata.command)
+            commands.append(metadata.comm)
+        return [gone.tobytes(), new.tobytes(), "\0".join(commands).encode(), changed_pids.tobytes(),
+                b"".join(column.tobytes() for column in changed)]
+
+class FlightFrame:
+    """One decoded tick. Objects are the same as in the frame before for
+    the collectors that didn't run in between."""
+    def __init__(self, wall_time, cpu_snapshot, table, mem_info_snapshot):
+        self.wall_time = wall_time
+        self.cpu_snapshot = cpu_snapshot
+        self.table = table
+        self.mem_info_snapshot = mem_info_snapshot
+
+class FlightDecoder:
+    """Reverses FlightEncoder, record by record from a keyframe on"""
+    def __init__(self):
+        self.cpu_snapshot = None
+        self.cpu_counters = None
+        self.mem_info_snapshot = None
+        self.table = None
+
+    def decode(self, record):
+        length, kind, flags, wall_time, cpu_uptime, process_uptime = FLIGHT_RECORD.unpack_from(record)
+        if kind != FLIGHT_KEYFRAME and self.table is None:
+            raise Exception("Flight recording doesn't start with a keyframe")
+        blobs = unpack_blobs(zlib.decompress(record[FLIGHT_RECORD.size:length]))
+        keyframe = kind == FLIGHT_KEYFRAME
+        # A keyframe has everything, but is only needed when starting there
+        if not (flags & FLIGHT_SAME_CPU and self.cpu_snapshot is not None):
+            counters = array('q', blobs[0])
+            if not keyframe:
+                counters = array('q', [p + d for p, d in zip(self.cpu_counters, counters)])
+            self.cpu_counters = counters
+            self.cpu_snapshot = CpuSnapshot.from_counters(cpu_uptime, counters)
+        if not (flags & FLIGHT_SAME_MEM and self.mem_info_snapshot is not None):
+            values = {} if keyframe else dict(self.mem_info_snapshot.values)
+            items = blobs[1].decode().split("\0") if blobs[1] else []
+            for i in range(0, len(items), 2):
+                values[items[i]] = items[i + 1]
+            self.mem_info_snapshot = MemInfoSnapshot(values)
+        if not (flags & FLIGHT_SAME_PROCESSES and self.table is not None):
+            self.table = FlightDecoder._decode_processes(None if keyframe else self.table, process_uptime, blobs[2:7])
+        return FlightFrame(wall_time, self.cpu_snapshot, self.table, self.mem_info_snapshot)
+
+    @staticmethod
+    def _decode_processes(previous, uptime, blobs):
+        gone = set(array('i', blobs[0]))
+        new = array('q', blobs[1])
+        commands = blobs[2].decode().split("\0") if blobs[2] else []
+        changed_pids = array('i', blobs[3])
+        changed = array('q', blobs[4])
+        new_count = len(new) // FLIGHT_NEW_COLUMNS
+        n = new_count
+        m = len(changed_pids)
+        changed_index = dict(zip(changed_pids, range(m)))
+        table = ProcessTable(uptime)
+
+        def append_new(i):
+            table.append(new[i], new[n + i], new[2 * n + i], new[3 * n + i], new[4 * n + i], new[5 * n + i], new[6 * n + i],
+                         new[7 * n + i], new[8 * n + i], ProcessMetadata(commands[2 * i], commands[2 * i + 1], new[9 * n + i], None))
+
+        i = 0
+        if previous is not None:
+            for row in range(len(previous)):
+                pid = previous.pid[row]
+                while i < new_count and new[i] < pid:
+                    append_new(i)
+                    i += 1
+                if pid in gone:
+                    continue
+                c = changed_index.get(pid)
+                if c is None:
+                    table.append_row(previous, row)
+                else:
+                    table.append(pid, previous.ppid[row] + changed[c], previous.state[row] + changed[m + c],
+                                 previous.utime[row] + changed[2 * m + c], previous.stime[row] + changed[3 * m + c],
+                                 previous.cutime[row] + changed[4 * m + c], previous.cstime[row] + changed[5 * m + c],
+                                 previous.starttime[row], previous.vsize[row] + changed[6 * m + c], previous.metadata[row])
+        while i < new_count:
+            append_new(i)
+            i += 1
+        return table
+
+class FlightRecorder:
+    """Appends every tick to a FlightRing. The encoding and writing happen
+    on the recorder's own thread, a tick that comes while the last one is
+    still being written is left out."""
+    KEYFRAME_INTERVAL = 60
+
+    def __init__(self, path, size):
+        self.ring = FlightRing(path, size)
+        self.encoder = FlightEncoder()
+        self.since_keyframe = 0
+        self.busy = False
+        self.closed = False
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="jill-recorder")
+
+    def record(self, state):
+        with self.lock:
+            if self.closed:
+                return
+            if self.busy:
+                # The next record is the difference to the last one written
+                self.dropped += 1
+                return
+            self.busy = True
+            self.executor.submit(self._write, time.time(), state)
+
+    def _write(self, wall_time, state):
+        try:
+            keyframe = self.since_keyframe >= FlightRecorder.KEYFRAME_INTERVAL
+            snapshot = state.snapshot
+            record = self.encoder.encode(wall_time, snapshot.cpu_snapshot, snapshot.process_snapshot.table, state.mem_info_snapshot, keyframe)
+            if record[4] == FLIGHT_KEYFRAME:
+                self.since_keyframe = 0
+            self.since_keyframe += 1
+            if not self.ring.append(record):
+                logging.error("Record of {} bytes doesn't fit into the flight recorder".format(len(record)))
+        except Exception:
+            logging.error(traceback.format_exc())
+        finally:
+            with self.lock:
+                self.busy = False
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.executor.shutdown(wait=True)
+        self.ring.close()
+        if self.dropped:
+            logging.info("Flight recorder left out {} ticks".format(self.dropped))
+
+class ModelState:
+    """Everything the UI shows from one tick. Never modified once published."""
+    def __init__(self, model):
+        self.snapshot = model.snapshot
+        self.delta = model.delta
+        self.selinux_info = model.selinux_info
+        self.battery_paths = list(model.battery_paths)
+        self.thermal_info = model.thermal_info
+        self.mem_info_snapshot = model.mem_info_snapshot
+        self.cpu_history = model.cpu_history_snapshot
+        self.power_infos = {}
+        for p in model.battery_paths:
+            self.power_infos[p] = PowerState(model.power_infos[p])
+        self.collector_timings = model.scheduler.timings()
+        self.replay = model.replay_position
+        self.self_usage = model.self_usage.percentage
+
+
+# Seconds, None for the sample interval. Overridden by 'collector-intervals'.
+DEFAULT_COLLECTOR_INTERVALS = {
+    'selinux' : 5.0,
+    'cpu' : None,
+    'processes' : None,
+    'mem' : 2.0,
+    'thermal' : 5.0,
+    'power' : 10.0
+}
+
+class JillModel:
+    def __init__(self, proc_root=PROC_ROOT, sys_root=SYS_ROOT, etc_root=ETC_ROOT, sample_interval=None):
+        self.proc_root = proc_root
+        self.sys_root = sys_root
+        self.selinux_reader = SELinuxReader(sys_root, etc_root)
+        if CONF.get('incremental-scan', True):
+            metadata_cache = ProcessMetadataCache(CONF.get('max-cached-processes', 100000))
+        else:
+            metadata_cache = ProcessMetadataCache(0)
+        self.scanner = ProcessScanner(metadata_cache, CONF.get('max-open-files', 4096), CONF.get('scan-workers', 1), proc_root,
+                                      CONF.get('process-events', False) and proc_root == '/proc')
+        self.user_database = UserDatabase(etc_root)
+        self.process_memory = ProcessMemoryCache(CONF.get('process-memory-ttl', 2.0), proc_root)
+        self.battery_paths = find_battery_paths(sys_root)
+        self.cpu_snapshot = None
+        self.cpu_delta = None
+        self.cpu_history = CpuHistory(CONF.get('cpu-history', 30))
+        self.cpu_history_snapshot = self.cpu_history.snapshot()
+        self.process_snapshot = None
+        self.process_delta = None
+        self.expanded_pids = frozenset()
+        self.expanded_lock = threading.Lock()
+        # Set while the I/O columns are shown
+        self.read_io = CONF.get('io-columns', False)
         self.power_infos = {}
         for p in self.battery_paths:
-            self.power_infos[p] = PowerInfo(p)
+            self.power_infos[p] = PowerInfo(p, sys_root)
+        if sample_interval is None:
+            sample_interval = CONF.get('sample-interval', 1.0)
+        intervals = JillModel.collector_intervals(sample_interval)
+        collect = {
+            'selinux' : self.collect_selinux,
+            'cpu' : self.collect_cpu,
+            'processes' : self.collect_processes,
+            'mem' : self.collect_mem,
+            'thermal' : self.collect_thermal,
+            'power' : self.collect_power
+        }
+        # SELinux first, the process scan needs to know if it's enabled
+        self.scheduler = CollectorScheduler([Collector(name, intervals[name], collect[name]) for name in DEFAULT_COLLECTOR_INTERVALS])
+        self.replay_position = None
+        self.self_usage = SelfUsage()
+        if CONF.get('flight-recorder'):
+            self.recorder = FlightRecorder(os.path.expanduser(CONF['flight-recorder']), int(CONF.get('flight-recorder-size', 256) * 1024 * 1024))
+        else:
+            self.recorder = None
+        # The first round, without deltas yet. All are due again on the first tick.
+        for name in DEFAULT_COLLECTOR_INTERVALS:
+            collect[name]()
+        self.snapshot = Snapshot(self.cpu_snapshot, self.process_snapshot)
+        self.delta = None
+        self.state = ModelState(self)
 
-    def time_tick(self):
-        self.selinux_info.reload()
-        new_snapshot = Snapshot(self.selinux_info(), UserSnapshot(), self.command_cache)
-        self.delta = Delta(self.snapshot, new_snapshot)
-        self.mem_info_snapshot = MemInfoSnapshot()
-        self.thermal_info = ThermalInfo()
+    @staticmethod
+    def collector_intervals(sample_interval):
+        intervals = {}
+        for name, interval in DEFAULT_COLLECTOR_INTERVALS.items():
+            intervals[name] = interval if interval is not None else sample_interval
+        for name, interval in CONF.get('collector-intervals', {}).items():
+            if name in intervals:
+                intervals[name] = float(interval)
+            else:
+                logging.error("Unknown collector '{}' in collector-intervals".format(name))
+        return intervals
+
+    def collect_selinux(self):
+        # A new SELinuxInfo only if something changed, published states must not change
+        self.selinux_info = self.selinux_reader.read()
+
+    def collect_cpu(self):
+        cpu_snapshot = CpuSnapshot(self.proc_root)
+        if self.cpu_snapshot is not None:
+            self.cpu_delta = CpuDelta(self.cpu_snapshot, cpu_snapshot)
+            self.cpu_history.add(self.cpu_delta)
+            self.cpu_history_snapshot = self.cpu_history.snapshot()
+        self.cpu_snapshot = cpu_snapshot
+
+    def collect_processes(self):
+        if not self.read_io:
+            self.scanner.close_io()
+        process_snapshot = ProcessSnapshot(self.selinux_info(), self.user_database.current(), read_uptime(self.proc_root), self.scanner,
+                                           self.expanded_pids, self.read_io)
+        if self.process_snapshot is not None:
+            self.process_delta = ProcessDelta(self.process_snapshot, process_snapshot)
+        self.process_snapshot = process_snapshot
+        with self.expanded_lock:
+            # Forget processes that are gone, their pids may come back for another one
+            self.expanded_pids = frozenset(p for p in self.expanded_pids if process_snapshot.table.find(p) >= 0)
+
+    def toggle_threads(self, pid):
+        """Shows or hides the threads of pid, from the next process scan on"""
+        with self.expanded_lock:
+            self.expanded_pids = self.expanded_pids ^ {pid}
+
+    def collect_mem(self):
+        self.mem_info_snapshot = MemInfoSnapshot(proc_root=self.proc_root)
+
+    def collect_thermal(self):
+        self.thermal_info = ThermalInfo(sys_root=self.sys_root)
+
+    def collect_power(self):
         for p in self.battery_paths:
             self.power_infos[p].take_snapshot()
-        self.snapshot = new_snapshot
 
+    def time_tick(self):
+        self.scheduler.run_due(time.monotonic())
+        self.snapshot = Snapshot(self.cpu_snapshot, self.process_snapshot)
+        self.delta = Delta(self.cpu_delta, self.process_delta)
+        self.self_usage.measure()
+        self.state = ModelState(self)
+        if self.recorder:
+            self.recorder.record(self.state)
+
+    def close(self):
+        self.process_memory.close()
+        self.scanner.close()
+        if self.recorder:
+            self.recorder.close()
+        self.log_collector_timings()
+
+    def log_collector_timings(self):
+        for t in self.scheduler.timings():
+            logging.info("Collector {}: every {:.1f} s, {} runs, last {:.2f} ms, average {:.2f} ms".format(
+                t.name, t.interval, t.runs, t.last_duration * 1000, t.average_duration * 1000))
+
+
+class RecordedScanner:
+    """Hands a recorded ProcessTable to ProcessSnapshot in place of a scan"""
+    def __init__(self, table):
+        self.table = table
+
+    def scan(self, uptime):
+        return self.table
+
+class RecordedProcessMemory:
+    """Memory of processes isn't recorded, there's nothing to read in a replay"""
+    generation = 0
+
+    def get(self, pid, starttime):
+        return ProcessMemory()
+
+    def close(self):
+        pass
+
+class FlightRecording:
+    """A file of the FlightRecorder opened for replay. Records before the
+    first keyframe can't be decoded and are skipped."""
+    def __init__(self, path):
+        self.ring = FlightRing(path)
+        self.offsets = list(self.ring.offsets())
+        keyframes = [i for i, o in enumerate(self.offsets) if self.ring.kind(o) == FLIGHT_KEYFRAME]
+        if keyframes:
+            self.offsets = self.offsets[keyframes[0]:]
+            self.keyframes = [k - keyframes[0] for k in keyframes]
+        else:
+            self.offsets = []
+            self.keyframes = []
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read(self, index):
+        return self.ring.read(self.offsets[index])
+
+    def keyframe_before(self, index):
+        """Index of the last keyframe at or before index"""
+        return self.keyframes[bisect.bisect_right(self.keyframes, index) - 1]
+
+    def close(self):
+        self.ring.close()
+
+class ReplayPosition:
+    def __init__(self, wall_time, index, count, playing):
+        self.wall_time = wall_time
+        self.index = index
+        self.count = count
+        self.playing = playing
+
+class ReplayModel:
+    """Plays a flight recording in place of JillModel. Moves on by one
+    recorded tick per time_tick while playing, step moves by hand."""
+    def __init__(self, path):
+        self.recording = FlightRecording(path)
+        if len(self.recording) < 2:
+            raise Exception("Not enough ticks recorded in %s" % path)
+        self.user_database = UserDatabase()
+        self.process_memory = RecordedProcessMemory()
+        self.selinux_info = SELinuxInfo("not recorded")
+        self.battery_paths = []
+        self.power_infos = {}
+        self.thermal_info = ThermalInfo([])
+        self.scheduler = CollectorScheduler([])
+        self.playing = True
+        # I/O counters aren't recorded
+        self.read_io = False
+        self.self_usage = SelfUsage()
+        self.lock = threading.Lock()
+        self.process_snapshots = {}
+        self._restart(0)
+        self._seek(1)
+        self._publish()
+
+    def _restart(self, index):
+        self.decoder = FlightDecoder()
+        self.position = index - 1
+        self.cpu_history = CpuHistory(CONF.get('cpu-history', 30))
+        # The last two objects each collector made, for the deltas
+        self.cpu_before = self.cpu_last = None
+        self.table_before = self.table_last = None
+
+    def _advance(self):
+        self.position += 1
+        frame = self.decoder.decode(self.recording.read(self.position))
+        self.wall_time = frame.wall_time
+        self.mem_info_snapshot = frame.mem_info_snapshot
+        if frame.cpu_snapshot is not self.cpu_last:
+            self.cpu_before, self.cpu_last = self.cpu_last, frame.cpu_snapshot
+            if self.cpu_before is not None:
+                self.cpu_history.add(CpuDelta(self.cpu_before, self.cpu_last))
+        if frame.table is not self.table_last:
+            self.table_before, self.table_last = self.table_last, frame.table
+
+    def _seek(self, index):
+        index = min(max(index, 1), len(self.recording) - 1)
+        if self.position < self.recording.keyframe_before(index) or self.position > index:
+            self._restart(self.recording.keyframe_before(index - 1))
+        while self.position < index:
+            self._advance()
+
+    def _process_snapshot(self, table):
+        process_snapshot = self.process_snapshots.get(table)
+        if process_snapshot is None:
+            process_snapshot = ProcessSnapshot(False, self.user_database.current(), table.uptime, RecordedScanner(table))
+        return process_snapshot
+
+    def _publish(self):
+        process_last = self._process_snapshot(self.table_last)
+        # Without a collection before in reach, the deltas are zero
+        process_before = self._process_snapshot(self.table_before) if self.table_before else process_last
+        self.process_snapshots = {self.table_last: process_last, process_before.table: process_before}
+        cpu_before = self.cpu_before if self.cpu_before else self.cpu_last
+        self.snapshot = Snapshot(self.cpu_last, process_last)
+        self.delta = Delta(CpuDelta(cpu_before, self.cpu_last), ProcessDelta(process_before, process_last))
+        self.cpu_history_snapshot = self.cpu_history.snapshot()
+        self.replay_position = ReplayPosition(self.wall_time, self.position, len(self.recording), self.playing)
+        self.self_usage.measure()
+        self.state = ModelState(self)
 
+    def time_tick(self):
+        with self.lock:
+            if self.playing:
+                if self.position < len(self.recording) - 1:
+                    self._seek(self.position + 1)
+                else:
+                    self.playing = False
+                self._publish()
 
+    def toggle_threads(self, pid):
+        # Threads aren't recorded
+        pass
 
+    def step(self, ticks):
+        with self.lock:
+            self.playing = False
+            self._seek(self.position + ticks)
+            self._publish()
+
+    def play(self):
+        with self.lock:
+            self.playing = not self.playing
+            self._publish()
+
+    def close(self):
+        self.recording.close()
+
+
+def read_self_cpu_time():
+    """Seconds of CPU jill used so far, all its threads and waited for children"""
+    with open("/proc/self/stat", "rb") as f:
+        buf = f.read()
+    pid, comm, state, ppid, utime, stime, cutime, cstime, starttime, vsize = parse_stat(buf, len(buf))
+    return (utime + stime + cutime + cstime) / CLOCK_TICKS
+
+class SelfUsage:
+    """Jill's own CPU usage in percent of one core, between two measure() calls"""
+    def __init__(self):
+        self.cpu_time = read_self_cpu_time()
+        self.time = time.monotonic()
+        self.percentage = 0.0
+
+    def measure(self):
+        cpu_time = read_self_cpu_time()
+        now = time.monotonic()
+        if now > self.time:
+            self.percentage = 100.0 * (cpu_time - self.cpu_time) / (now - self.time)
+        self.cpu_time = cpu_time
+        self.time = now
+        return self.percentage
+
+class GovernorDecision:
+    def __init__(self, wall_time, usage, old_interval, new_interval):
+        self.wall_time = wall_time
+        self.usage = usage
+        self.old_interval = old_interval
+        self.new_interval = new_interval
+
+class SamplingGovernor:
+    """Keeps jill within a CPU budget, in percent of one core. Every few
+    ticks it lengthens the sample interval if jill used more than the
+    budget since its last look, and shortens it again towards the
+    configured interval once jill uses less than half of it."""
+    TICKS = 5
+    FACTOR = 1.5
+
+    def __init__(self, interval, budget, max_interval):
+        self.base_interval = interval
+        self.interval = interval
+        self.budget = budget
+        self.max_interval = max(interval, max_interval)
+        self.usage = SelfUsage()
+        self.ticks = 0
+        self.decisions = collections.deque(maxlen=5)
+
+    def tick(self):
+        """The interval until the next tick"""
+        self.ticks += 1
+        if self.ticks < SamplingGovernor.TICKS:
+            return self.interval
+        self.ticks = 0
+        usage = self.usage.measure()
+        if usage > self.budget:
+            interval = min(self.max_interval, self.interval * SamplingGovernor.FACTOR)
+        elif usage < self.budget / 2:
+            interval = max(self.base_interval, self.interval / SamplingGovernor.FACTOR)
+        else:
+            interval = self.interval
+        if interval != self.interval:
+            logging.info("Governor: jill used {:.1f}% of a core, budget {:.1f}%, sample interval {:.2f} s -> {:.2f} s".format(
+                usage, self.budget, self.interval, interval))
+            self.decisions.append(GovernorDecision(time.time(), usage, self.interval, interval))
+            self.interval = interval
+        return self.interval
+
+def tick_schedule(interval, wait=time.sleep):
+    """Yields every interval() seconds, the first time right away. Work
+    between two yields that takes longer than the interval delays the
+    schedule instead of being caught up on. Ends when wait(seconds)
+    returns true."""
+    next_tick = time.monotonic()
+    delay = 0
+    while not wait(delay):
+        yield
+        next_tick += interval()
+        now = time.monotonic()
+        if next_tick < now:
+            # Collection took longer than the interval, don't try to catch up
+            next_tick = now
+        delay = next_tick - now
+
+class Sampler(threading.Thread):
+    """Runs JillModel.time_tick every interval seconds on its own thread.
+    Readers only ever see complete ModelState objects via latest()."""
+    def __init__(self, model, interval, governor=None):
+        super(Sampler, self).__init__(name="jill-sampler", daemon=True)
+        self.model = model
+        self.interval = interval
+        self.governor = governor
+        self.first_tick = threading.Event()
+        self._stop_event = threading.Event()
+
+    def latest(self):
+        return self.model.state
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        for i in tick_schedule(lambda: self.interval, self._stop_event.wait):
+            t = PHASE_TIMINGS.start()
+            try:
+                self.model.time_tick()
+            except Exception:
+                logging.error(traceback.format_exc())
+            PHASE_TIMINGS.stop("model.time_tick", t)
+            self.first_tick.set()
+            if self.governor:
+                self.interval = self.governor.tick()
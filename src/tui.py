@@ -6,6 +6,7 @@ import traceback
 
 from .conf import CONF, GRAPH_CHAR
 from .util import Dispatcher, dispatcher, Filler, split_evenly, LinkedList
+from .util import PHASE_TIMINGS
 
         
 
@@ -417,14 +418,41 @@ class Table(Canvas):
     def set_value(self, row, column, value):
         self._extend_data_list(row, column)
         self._data[row][column] = value
-        if self.columns[column].visible and len(value) > self.col_widths[column]:
-            self.col_widths[column] = len(value)
+        self._fit_column(column, len(value))
+        self._update_min_height()
+
+    def set_rows(self, rows, col_widths):
+        """Replace all data at once. A row can be any sequence of cells, it is
+        only indexed when it is written, so cells of rows scrolled out of view
+        are never computed. col_widths are the widths the cells will need."""
+        self._data = rows
+        while len(self.col_widths) < len(col_widths):
+            self.col_widths.append(0)
+            self.columns.append(TableColumn(""))
+        for column, width in enumerate(col_widths):
+            self._fit_column(column, width)
+        self._update_min_height()
+
+    def _fit_column(self, column, width):
+        if self.columns[column].visible and width > self.col_widths[column]:
+            self.col_widths[column] = width
             if self.columns[column].max_width and self.columns[column].max_width < self.col_widths[column]:
                 self.col_widths[column] = self.columns[column].max_width
-            sum = 0
-            for s in self.col_widths:
-                sum += s
-            self.min_width = sum + len(self.col_widths) - 1
+            self._update_min_width()
+
+    def _update_min_width(self):
+        """Hidden columns have neither width nor a separator"""
+        widths = [w for w, c in zip(self.col_widths, self.columns) if c.visible]
+        self.min_width = sum(widths) + max(0, len(widths) - 1)
+
+    def set_column_visible(self, column, visible):
+        self.columns[column].visible = visible
+        self.col_widths[column] = (self.columns[column].min_width or 0) if visible else 0
+        self._update_min_width()
+        # Whatever is aligned with the columns moves
+        self.layout_valid = False
+
+    def _update_min_height(self):
         if self.row_limit:
             self.min_height = min(self.row_limit, len(self._data))
         else:
@@ -442,26 +470,26 @@ class Table(Canvas):
         else:
             header_offset = 0
         scroll_offset = max(0, self.selected_row_index - self.h + header_offset + 1)
-        for row_index, row in enumerate(self._data):
-            if row_index - scroll_offset >= 0 and row_index - scroll_offset < self.h - header_offset:
-                style = curses.A_NORMAL
-                if self.has_focus:
-                    # selected row as A_REVERSE
-                    if row_index == self.selected_row_index:
-                        style = curses.A_REVERSE
-                else:
-                    if self.always_highlight_selection:
-                        # selected row and the one above as underline
-                        if row_index == self.selected_row_index or row_index + 1 == self.selected_row_index:
-                            style = curses.A_UNDERLINE
-                    
-                cell_y = y + row_index - scroll_offset + header_offset
-                cell_x = x
-                for col_index, cell in enumerate(row):
-                    if self.columns[col_index].visible:
-                        txt = cell.ljust(self.col_widths[col_index] + 1)
-                        self.write_safe(stdscr, cell_x, cell_y, max_x, max_y, txt, style)
-                    cell_x += self.col_widths[col_index] + (1 if self.columns[col_index].visible else 0)
+        for row_index in range(scroll_offset, min(len(self._data), scroll_offset + self.h - header_offset)):
+            row = self._data[row_index]
+            style = curses.A_NORMAL
+            if self.has_focus:
+                # selected row as A_REVERSE
+                if row_index == self.selected_row_index:
+                    style = curses.A_REVERSE
+            else:
+                if self.always_highlight_selection:
+                    # selected row and the one above as underline
+                    if row_index == self.selected_row_index or row_index + 1 == self.selected_row_index:
+                        style = curses.A_UNDERLINE
+                
+            cell_y = y + row_index - scroll_offset + header_offset
+            cell_x = x
+            for col_index, cell in enumerate(row):
+                if self.columns[col_index].visible:
+                    txt = cell.ljust(self.col_widths[col_index] + 1)
+                    self.write_safe(stdscr, cell_x, cell_y, max_x, max_y, txt, style)
+                cell_x += self.col_widths[col_index] + (1 if self.columns[col_index].visible else 0)
 
 class Label(Canvas):
     def __init__(self, text, style=curses.A_NORMAL, width=None):
@@ -550,14 +578,14 @@ class FilterTable(Container):
     def layout(self, w, h):
         self.w = w
         self.h = h
-        self.table.h = h - 1
-        self.table.w = w - 0
+        self.table.layout(w, h - 1)
         self.layout_valid = True
         x = 0
         for i, s in enumerate(self.search_fields):
-            col_width = self.table.col_widths[i]
+            visible = self.table.columns[i].visible
             s.x = x
-            s.w = col_width + 1
+            s.w = self.table.col_widths[i] + 1 if visible else 0
+            s.can_focus = visible
             x += s.w
 
 def component_coordinates_to_str(c):
@@ -619,6 +647,8 @@ class Screen:
     def __init__(self, root_component):
         self.root_component = root_component
         self.focus_mgr = FocusManager(root_component)
+        # Drawn over the root component in the lower right corner, if set
+        self.overlay = None
 
     def __set_cursor(self, stdscr, x, y, components):
         last = components.pop()
@@ -631,6 +661,8 @@ class Screen:
         stdscr.clear()
         max_y, max_x = stdscr.getmaxyx()
         self.root_component.write(stdscr, 0, 0, max_x, max_y)
+        if self.overlay:
+            self.__write_overlay(stdscr, max_x, max_y)
         in_focus = self.focus_mgr.focusable_components.current()
         if in_focus:
             path = []
@@ -640,6 +672,13 @@ class Screen:
                 p = p.parent
             self.__set_cursor(stdscr, 0, 0, path)
 
+    def __write_overlay(self, stdscr, max_x, max_y):
+        o = self.overlay
+        o.w = min(o.min_width, max_x - 1)
+        o.h = min(o.min_height, max_y)
+        o.layout(o.w, o.h)
+        o.write(stdscr, max_x - 1 - o.w, max_y - o.h, max_x, max_y)
+
     def focus_prev(self):
         if self.focus_mgr.focusable_components:
             self.focus_mgr.prev()
@@ -680,17 +719,25 @@ class Tui:
         elif c == 353: # SHIFT-TAB
             sc.focus_prev()
         elif c == -1: # Timeout, no key pressed
-            #sc.time_tick()
-            pass
+            if not sc.needs_update():
+                return
         else: # let current screen decide what to do
             sc.handle_key(c)
+        t = PHASE_TIMINGS.start()
         sc.time_tick()
+        PHASE_TIMINGS.stop("ui.time_tick", t)
         if not sc.view.layout_valid:
+            t = PHASE_TIMINGS.start()
             sc.view.layout(sc.cols, sc.rows)
+            PHASE_TIMINGS.stop("ui.layout", t)
         #for l in full_components_as_list(sc.view):
         #    logging.info("==>{}".format(l))
+        t = PHASE_TIMINGS.start()
         sc.write(self._stdscr)
+        PHASE_TIMINGS.stop("ui.write", t)
+        t = PHASE_TIMINGS.start()
         self._stdscr.refresh()
+        PHASE_TIMINGS.stop("ui.refresh", t)
         
         
         #logging.info("==== Components that can get focus: ====")
@@ -1,5 +1,9 @@
 import logging
+import math
 import subprocess
+import time
+
+from array import array
 
 MEM_UNITS = "B KB MB GB TB".split()
 
@@ -220,3 +224,67 @@ class LinkedList:
             result.append(t.obj)
             t = t.next
         return result
+
+
+class RollingDurations:
+    """The last size durations of a phase in nanoseconds. A ring buffer,
+    it doesn't grow however long jill runs."""
+    def __init__(self, size):
+        self.values = array('q', bytes(8 * size))
+        self.count = 0
+
+    def add(self, ns):
+        self.values[self.count % len(self.values)] = ns
+        self.count += 1
+
+    def percentiles(self, ps):
+        """Nearest rank percentiles of the durations in the ring"""
+        filled = sorted(self.values[:min(self.count, len(self.values))])
+        if not filled:
+            return [0] * len(ps)
+        n = len(filled)
+        return [filled[max(0, min(n - 1, math.ceil(p / 100.0 * n) - 1))] for p in ps]
+
+class PhaseTiming:
+    def __init__(self, name, durations):
+        self.name = name
+        self.count = durations.count
+        self.p50, self.p90, self.p99, self.max = durations.percentiles([50, 90, 99, 100])
+
+class PhaseTimings:
+    """Durations of named phases, measured with time.monotonic_ns:
+
+        t = PHASE_TIMINGS.start()
+        ...
+        PHASE_TIMINGS.stop("ui.write", t)
+
+    While disabled start() and stop() only check a flag."""
+    def __init__(self, size=256):
+        self.enabled = False
+        self.size = size
+        self.phases = {}
+
+    def start(self):
+        return time.monotonic_ns() if self.enabled else 0
+
+    def stop(self, name, start):
+        if start:
+            self.add(name, time.monotonic_ns() - start)
+
+    def add(self, name, ns):
+        durations = self.phases.get(name)
+        if durations is None:
+            durations = self.phases.setdefault(name, RollingDurations(self.size))
+        durations.add(ns)
+
+    def timings(self):
+        # Phases are added from the sampler thread too, copy before iterating
+        return [PhaseTiming(name, d) for name, d in sorted(list(self.phases.items()))]
+
+    def log(self):
+        logging.info("Phase timings of the last {} runs [ms]:".format(self.size))
+        for t in self.timings():
+            logging.info("  {:<24} runs {:>7}  p50 {:8.3f}  p90 {:8.3f}  p99 {:8.3f}  max {:8.3f}".format(
+                t.name, t.count, t.p50 / 1e6, t.p90 / 1e6, t.p99 / 1e6, t.max / 1e6))
+
+PHASE_TIMINGS = PhaseTimings()
@@ -0,0 +1,109 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.model import ProcessTable, ProcessSnapshot, ProcessInfo, ProcessMetadata, ProcessFilter, ROOT_METADATA
+
+# Types filters into the process view of a synthetic snapshot, one character
+# at a time, and times every keystroke. Checks the results against a filter
+# without index and memory, and compares the time with testing every process
+# one by one like before.
+#
+#   python3 test/bench_filter.py [processes]
+
+USERS = {0: 'root', 33: 'www-data', 999: 'postgres', 1000: 'alice'}
+
+def make_command(r, pid):
+    kind = r.randrange(6)
+    if kind == 0:
+        return "kworker/{}:{}-events".format(r.randrange(64), r.randrange(4))
+    if kind == 1:
+        return "nginx: worker process"
+    if kind == 2:
+        return "/usr/bin/python3 /srv/app/worker.py --queue q{} --id {}".format(r.randrange(50), pid)
+    if kind == 3:
+        return "postgres: app appdb 10.0.{}.{}({}) idle".format(r.randrange(256), r.randrange(256), r.randrange(30000, 60000))
+    if kind == 4:
+        return "/usr/lib/jvm/java-17/bin/java -Xmx4g -cp " + ":".join("/opt/lib/dep{}.jar".format(i) for i in range(40)) + " com.example.Main"
+    return "/bin/bash -c sleep {}".format(r.randrange(1000))
+
+class SyntheticScanner:
+    def __init__(self, count):
+        self.count = count
+
+    def scan(self, uptime):
+        r = random.Random(1)
+        table = ProcessTable(uptime)
+        table.append(0, -1, ord('S'), 0, 0, 0, 0, 0, 0, ROOT_METADATA)
+        for pid in range(1, self.count + 1):
+            ppid = 0 if pid < 3 else r.randrange(1, pid)
+            uid = r.choice(list(USERS))
+            command = make_command(r, pid)
+            table.append(pid, ppid, ord('S'), 0, 0, 0, 0, pid, 0, ProcessMetadata(command, command[:15], uid, None))
+        return table
+
+class Users:
+    def username(self, uid):
+        return USERS.get(uid, str(uid))
+
+def typed(field, text):
+    values = {'UID': '', 'PID': '', 'COMMAND': ''}
+    for i in range(1, len(text) + 1):
+        values[field] = text[:i]
+        yield dict(values)
+
+def legacy_matches(user_snapshot, process_info, filter_values):
+    """The filter of every process before ProcessFilter"""
+    username = user_snapshot.username(process_info.uid)
+    if filter_values['UID'] not in username:
+        return False
+    if filter_values['PID'] not in str(process_info.pid):
+        return False
+    if filter_values['COMMAND'] not in process_info.comm:
+        return False
+    return True
+
+def legacy_rows(process_snapshot, filter_values):
+    rows = []
+    for row in range(len(process_snapshot.table)):
+        if legacy_matches(process_snapshot.user_snapshot, ProcessInfo(process_snapshot.table, row), filter_values):
+            rows.append(row)
+    return rows
+
+def run(process_snapshot, field, text):
+    process_filter = ProcessFilter()
+    process_filter.command_index.follow(process_snapshot.table)
+    worst_legacy = 0
+    worst_new = 0
+    for filter_values in typed(field, text):
+        t = time.perf_counter()
+        legacy_rows(process_snapshot, filter_values)
+        worst_legacy = max(worst_legacy, time.perf_counter() - t)
+        expected = ProcessFilter(command_index=False).matching_rows(process_snapshot, filter_values)
+        t = time.perf_counter()
+        rows = process_filter.matching_rows(process_snapshot, filter_values)
+        worst_new = max(worst_new, time.perf_counter() - t)
+        if rows != expected:
+            print("  MISMATCH for {}".format(filter_values))
+    print("  {:<8} {:<26} {:>8} {:>14.1f} {:>14.1f}".format(field, repr(text), len(rows), worst_legacy * 1000, worst_new * 1000))
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+t = time.perf_counter()
+process_snapshot = ProcessSnapshot(False, Users(), 1.0, SyntheticScanner(count))
+print("Synthetic snapshot of {} processes in {:.1f} s".format(count, time.perf_counter() - t))
+
+t = time.perf_counter()
+ProcessFilter().command_index.follow(process_snapshot.table)
+print("Building the command index: {:.1f} ms".format((time.perf_counter() - t) * 1000))
+
+print("  {:<8} {:<26} {:>8} {:>14} {:>14}".format("field", "typed", "matches", "legacy [ms]", "filter [ms]"))
+run(process_snapshot, 'COMMAND', "worker.py --queue q17")
+run(process_snapshot, 'COMMAND', "nginx")
+run(process_snapshot, 'COMMAND', "dep39.jar")
+run(process_snapshot, 'COMMAND', "/queue q(3|4)\\b")
+run(process_snapshot, 'COMMAND', "postgres*idle")
+run(process_snapshot, 'PID', "4711")
+run(process_snapshot, 'UID', "postgres")
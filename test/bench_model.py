@@ -0,0 +1,193 @@
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.model import JillModel, CpuSnapshot, CpuDelta, MemInfoSnapshot, ProcessDelta
+from make_proc_tree import ProcTree
+
+# Benchmarks the model layer on synthetic trees of make_proc_tree.py, at
+# every process count given. Prints latency percentiles per call and the
+# peak of the memory a call allocates (tracemalloc, in a separate run so it
+# doesn't slow down the timed ones). Every case is timed in --passes
+# separate passes, interleaved with the other cases; "best" is the median
+# over the passes of the fastest call of each pass.
+#
+#   python3 test/bench_model.py [processes ...] [--rounds N] [--passes N]
+#   python3 test/bench_model.py --save          # keep the results as baseline
+#   python3 test/bench_model.py --compare       # compare with the baseline
+#
+# --compare exits with 1 if a case got slower or needs more memory than
+# the baseline by more than --threshold. A virtual machine easily runs a
+# whole benchmark 1.8 times slower than the one before, so every pass also
+# times a fixed calibration workload and the times are compared relative to
+# it. A case only counts as slower if all its passes are slower than all
+# passes of the baseline, and by more than --floor ms. Memory needs to grow
+# by more than --memory-floor KB. Baselines are only comparable on the
+# same machine.
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_model.baseline.json")
+
+def percentile(sorted_values, p):
+    """Nearest rank percentile"""
+    index = max(0, min(len(sorted_values) - 1, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def time_pass(call, rounds, before=None):
+    """Latencies in ms of rounds calls, before runs untimed ahead of every call"""
+    durations = []
+    for i in range(rounds):
+        if before:
+            before()
+        t = time.perf_counter()
+        call()
+        durations.append((time.perf_counter() - t) * 1000)
+    return durations
+
+def calibration():
+    """Fixed pure Python work, times the speed of the machine at the moment"""
+    names = {}
+    for i in range(2000):
+        names[i] = "%d:%d" % (i, i * 7)
+    return sorted(names.values(), reverse=True)
+
+def peak_kb(call, before=None):
+    """Peak KB allocated by one call"""
+    if before:
+        before()
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024.0
+
+def summarize(passes, reference, peak):
+    """passes are the latencies of every pass, reference the calibration
+    time of every pass. relative is the fastest call of every pass in
+    calibration times, sorted."""
+    durations = sorted(d for durations in passes for d in durations)
+    relative = sorted(min(durations) / r for durations, r in zip(passes, reference))
+    return {
+        'best' : statistics.median(min(durations) for durations in passes),
+        'relative' : relative,
+        'p50' : percentile(durations, 50),
+        'p90' : percentile(durations, 90),
+        'p99' : percentile(durations, 99),
+        'max' : durations[-1],
+        'peak_kb' : peak
+    }
+
+def cases(tree):
+    model = JillModel(tree.proc_root, tree.sys_root, tree.etc_root)
+    # Every collector on every tick, the benchmark ticks faster than the intervals
+    for c in model.scheduler.collectors:
+        c.interval = 0.0
+    tree.tick()
+    model.time_tick()
+    state = model.state
+    process_snapshot = state.snapshot.process_snapshot
+    process_delta = state.delta.process_delta
+    pids = list(process_snapshot.table.pid)
+    cpu_before = CpuSnapshot(tree.proc_root)
+    tree.tick()
+    cpu_after = CpuSnapshot(tree.proc_root)
+    return model, [
+        ('CpuSnapshot', lambda: CpuSnapshot(tree.proc_root), None),
+        ('CpuDelta', lambda: CpuDelta(cpu_before, cpu_after), None),
+        ('MemInfoSnapshot', lambda: MemInfoSnapshot(proc_root=tree.proc_root), None),
+        ('ProcessDelta', lambda: ProcessDelta(process_delta.process_snapshot1, process_delta.process_snapshot2), None),
+        ('ProcessDelta.cpu_usage', lambda: [process_delta.cpu_usage(pid) for pid in pids], None),
+        ('get_process_lines', lambda: process_snapshot.get_process_lines(process_delta), None),
+        ('JillModel.time_tick', model.time_tick, tree.tick)
+    ]
+
+def run(count, rounds, passes):
+    root = tempfile.mkdtemp(prefix="jill-proc-")
+    try:
+        tree = ProcTree(root, count, 8, 80, 0.01)
+        model, timed = cases(tree)
+        durations = dict((name, []) for name, call, before in timed)
+        reference = []
+        try:
+            # Cases take turns, a slow moment of the machine spreads over all
+            for i in range(passes):
+                reference.append(min(time_pass(calibration, rounds)))
+                for name, call, before in timed:
+                    durations[name].append(time_pass(call, rounds, before))
+            return dict((name, summarize(durations[name], reference, peak_kb(call, before))) for name, call, before in timed)
+        finally:
+            model.close()
+    finally:
+        shutil.rmtree(root)
+
+def compare(results, baseline, threshold, floor, memory_floor):
+    """Prints the ratios to the baseline, returns the number of regressions.
+    The time ratio is the one of the median relative times."""
+    regressions = 0
+    print("{:>8} {:<24} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+        "count", "case", "best [ms]", "base", "ratio", "peak [KB]", "base", "ratio"))
+    for count, cases in results.items():
+        for name, r in cases.items():
+            b = baseline.get(count, {}).get(name)
+            if b is None or 'relative' not in b:
+                print("{:>8} {:<24} {:>10.3f} {:>10} {:>8} {:>10.0f}".format(count, name, r['best'], "-", "", r['peak_kb']))
+                continue
+            time_ratio = statistics.median(r['relative']) / statistics.median(b['relative'])
+            memory_ratio = r['peak_kb'] / b['peak_kb'] if b['peak_kb'] else 1.0
+            # Not just a slow moment of the machine
+            apart = r['relative'][0] > b['relative'][-1]
+            slower = time_ratio > threshold and apart and r['best'] - b['best'] > floor
+            bigger = memory_ratio > threshold and r['peak_kb'] - b['peak_kb'] > memory_floor
+            worse = slower or bigger
+            regressions += worse
+            print("{:>8} {:<24} {:>10.3f} {:>10.3f} {:>8.2f} {:>10.0f} {:>10.0f} {:>8.2f}{}".format(
+                count, name, r['best'], b['best'], time_ratio, r['peak_kb'], b['peak_kb'], memory_ratio, "  REGRESSION" if worse else ""))
+    return regressions
+
+parser = argparse.ArgumentParser()
+parser.add_argument("counts", type=int, nargs="*", default=[1000, 10000], help="process counts")
+parser.add_argument("--rounds", type=int, default=10, help="calls per pass")
+parser.add_argument("--passes", type=int, default=5, help="separate timing passes per case")
+parser.add_argument("--save", nargs="?", const=DEFAULT_BASELINE, metavar="FILE", help="save the results as baseline")
+parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, metavar="FILE", help="compare with a saved baseline")
+parser.add_argument("--threshold", type=float, default=1.5, help="ratio to the baseline that counts as regression")
+parser.add_argument("--floor", type=float, default=0.05, help="ms a case may get slower regardless of the ratio")
+parser.add_argument("--memory-floor", type=float, default=64.0, help="KB a case may need more regardless of the ratio")
+args = parser.parse_args()
+
+results = {}
+print("{:>8} {:<24} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+    "count", "case", "best [ms]", "p50 [ms]", "p90 [ms]", "p99 [ms]", "max [ms]", "peak [KB]"))
+for count in args.counts:
+    # JSON keys are strings, keep them that way from the start
+    results[str(count)] = run(count, args.rounds, args.passes)
+    for name, r in results[str(count)].items():
+        print("{:>8} {:<24} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.0f}".format(
+            count, name, r['best'], r['p50'], r['p90'], r['p99'], r['max'], r['peak_kb']))
+print("Max RSS of the benchmark: {:.0f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+if args.save:
+    with open(args.save, "w") as f:
+        json.dump({'python' : platform.python_version(), 'machine' : platform.node(), 'rounds' : args.rounds, 'passes' : args.passes, 'results' : results}, f, indent=2)
+    print("Baseline saved to {}".format(args.save))
+
+if args.compare:
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    print()
+    print("Compared with {} ({}, Python {})".format(args.compare, baseline['machine'], baseline['python']))
+    regressions = compare(results, baseline['results'], args.threshold, args.floor, args.memory_floor)
+    if regressions:
+        print("{} regressions".format(regressions))
+        sys.exit(1)
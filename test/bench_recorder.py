@@ -0,0 +1,165 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.model import CpuSnapshot, MemInfoSnapshot, ProcessTable, ProcessMetadata, ROOT_METADATA
+from src.model import FlightEncoder, FlightDecoder, FlightRecorder, FlightRing, FlightRecording, ReplayModel, cpu_counters
+
+# Records synthetic ticks the way the flight recorder does: a set of busy
+# processes gets CPU time every tick, a few processes start and exit.
+# Prints the time per record, the bytes per tick and what a day of
+# 1 second ticks takes, then replays the file and checks every tick.
+# The same ticks are recorded once more into a ring of a quarter of their
+# size, which wraps around several times. Every tick still in it is
+# checked again, decoded directly and through ReplayModel, forward and
+# stepping back across keyframes.
+#
+#   python3 test/bench_recorder.py [processes] [ticks]
+
+CORES = 8
+
+def make_table(uptime, processes):
+    table = ProcessTable(uptime)
+    table.append(0, -1, ord('0'), 0, 0, 0, 0, 0, 0, ROOT_METADATA)
+    for pid in sorted(processes):
+        p = processes[pid]
+        table.append(pid, p[0], p[1], p[2], p[3], 0, 0, p[4], p[5], p[6])
+    return table
+
+def tick(r, processes, next_pid, busy):
+    for pid in busy:
+        if pid in processes:
+            p = processes[pid]
+            p[1] = ord('R') if r.random() < 0.3 else ord('S')
+            p[2] += r.randrange(0, 50)
+            p[3] += r.randrange(0, 10)
+    for i in range(r.randrange(0, 3)):
+        command = "/bin/sh -c job {}".format(next_pid)
+        processes[next_pid] = [1, ord('S'), 0, 0, next_pid, 8000000, ProcessMetadata(command, "sh", 1000, None)]
+        next_pid += 1
+    for pid in r.sample(sorted(processes), r.randrange(0, 3)):
+        if pid not in busy:
+            del processes[pid]
+    return next_pid
+
+def cpu_snapshot(r, uptime, counters):
+    for i in range(len(counters)):
+        counters[i] += r.randrange(0, 100)
+    return CpuSnapshot.from_counters(uptime, counters)
+
+def record(path, capacity, count, ticks):
+    """Records ticks into a ring of capacity bytes, returns what every tick
+    has to decode to, the time per record and the bytes written"""
+    r = random.Random(1)
+    processes = {}
+    for pid in range(1, count + 1):
+        command = "/usr/bin/daemon --instance {}".format(pid)
+        processes[pid] = [1, ord('S'), 0, 0, pid, 50000000, ProcessMetadata(command, "daemon", 0, None)]
+    busy = r.sample(range(1, count + 1), count // 20)
+    next_pid = count + 1
+    counters = [0] * (10 * (CORES + 1))
+    mem_values = {'MemTotal': "16000000 kB", 'MemFree': "8000000 kB", 'MemAvailable': "12000000 kB"}
+    ring = FlightRing(path, capacity)
+    encoder = FlightEncoder()
+    expected = []
+    durations = []
+    total_bytes = 0
+    for i in range(ticks):
+        uptime = 1000.0 + i
+        next_pid = tick(r, processes, next_pid, busy)
+        table = make_table(uptime, processes)
+        cpu = cpu_snapshot(r, uptime, counters)
+        if i % 2 == 0:
+            mem_values = dict(mem_values, MemFree="{} kB".format(8000000 + r.randrange(-5000, 5000)))
+            mem = MemInfoSnapshot(mem_values)
+        t = time.perf_counter()
+        record = encoder.encode(time.time(), cpu, table, mem, i % FlightRecorder.KEYFRAME_INTERVAL == 0)
+        if not ring.append(record):
+            raise Exception("Record of {} bytes doesn't fit into {} bytes".format(len(record), capacity))
+        durations.append(time.perf_counter() - t)
+        total_bytes += len(record)
+        expected.append((list(table.pid), list(table.utime), list(table.state), cpu_counters(cpu), mem.values))
+    ring.close()
+    return expected, durations, total_bytes
+
+def values(table, cpu, mem):
+    return (list(table.pid), list(table.utime), list(table.state), cpu_counters(cpu), mem.values)
+
+def replay(path, expected):
+    """Decodes every tick of the recording in order, returns the number of
+    mismatches and the seconds per tick. The recording has the last ticks
+    of expected, from its first keyframe that is still there."""
+    recording = FlightRecording(path)
+    first = len(expected) - len(recording)
+    decoder = FlightDecoder()
+    t = time.perf_counter()
+    mismatches = 0
+    for i in range(len(recording)):
+        frame = decoder.decode(recording.read(i))
+        if values(frame.table, frame.cpu_snapshot, frame.mem_info_snapshot) != expected[first + i]:
+            mismatches += 1
+    seconds = (time.perf_counter() - t) / len(recording)
+    recording.close()
+    return mismatches, seconds
+
+def replay_model(path, expected):
+    """Plays the recording in a ReplayModel, then steps back to earlier
+    ticks, which restarts from the keyframe before them. Returns the ticks
+    checked and the mismatches."""
+    model = ReplayModel(path)
+    first = len(expected) - len(model.recording)
+    checked = 0
+    mismatches = 0
+
+    def check():
+        state = model.state
+        actual = values(state.snapshot.process_snapshot.table, state.snapshot.cpu_snapshot, state.mem_info_snapshot)
+        return actual != expected[first + state.replay.index]
+
+    try:
+        while True:
+            mismatches += check()
+            checked += 1
+            if model.state.replay.index + 1 >= len(model.recording):
+                break
+            model.time_tick()
+        r = random.Random(2)
+        for i in range(20):
+            model.step(-r.randrange(1, FlightRecorder.KEYFRAME_INTERVAL * 2))
+            mismatches += check()
+            checked += 1
+    finally:
+        model.close()
+    return checked, mismatches
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+
+path = os.path.join(tempfile.mkdtemp(), "jill.rec")
+expected, durations, total_bytes = record(path, 1024 * 1024 * 1024, count, ticks)
+per_tick = total_bytes / ticks
+print("{} processes, {} ticks".format(count, ticks))
+print("  encode and write: average {:.2f} ms, max {:.2f} ms".format(sum(durations) / ticks * 1000, max(durations) * 1000))
+print("  {:.0f} bytes per tick, {:.0f} MB per day of 1 second ticks".format(per_tick, per_tick * 86400 / 1024 / 1024))
+mismatches, seconds = replay(path, expected)
+print("  replay: {:.2f} ms per tick, {} mismatches".format(seconds * 1000, mismatches))
+os.remove(path)
+
+# Big enough for two keyframe intervals, or nothing after the wrap can be decoded
+capacity = max(total_bytes // 4, int(per_tick * FlightRecorder.KEYFRAME_INTERVAL * 2.5))
+expected, durations, total_bytes = record(path, capacity, count, ticks)
+recording = FlightRecording(path)
+kept = len(recording)
+recording.close()
+print("  ring of {} KB, wrapped {:.1f} times, {} ticks to replay".format(capacity // 1024, total_bytes / capacity, kept))
+mismatches, seconds = replay(path, expected)
+print("  replay after wrapping: {} mismatches".format(mismatches))
+checked, model_mismatches = replay_model(path, expected)
+print("  ReplayModel after wrapping: {} ticks, {} mismatches".format(checked, model_mismatches))
+os.remove(path)
+if mismatches or model_mismatches or total_bytes <= capacity:
+    sys.exit(1)
@@ -0,0 +1,60 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.model import ProcessMetadataCache, ProcessScanner
+
+# Measures ProcessScanner.scan with 1, 2, 4, ... worker threads.
+# Starts extra sleeping processes first so there is something to scan.
+#
+#   python3 test/bench_scan.py [extra processes] [max workers]
+
+ROUNDS = 10
+
+def start_sleepers(count):
+    sleepers = []
+    for i in range(count):
+        sleepers.append(subprocess.Popen(['sleep', '600']))
+    return sleepers
+
+def measure(workers):
+    scanner = ProcessScanner(ProcessMetadataCache(100000), 4096 * workers, workers)
+    # The first scan fills the metadata cache and the descriptor pools
+    t = time.perf_counter()
+    count = len(scanner.scan(1.0))
+    cold = time.perf_counter() - t
+    times = []
+    for i in range(ROUNDS):
+        t = time.perf_counter()
+        scanner.scan(1.0)
+        times.append(time.perf_counter() - t)
+    if scanner.executor:
+        scanner.executor.shutdown()
+    for proc_files in scanner.proc_files:
+        proc_files.close_all()
+    return count, cold, statistics.median(times)
+
+extra = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+print("Starting {} sleeping processes".format(extra))
+sleepers = start_sleepers(extra)
+try:
+    print("{:>8} {:>10} {:>12} {:>12} {:>8}".format("workers", "processes", "cold [ms]", "warm [ms]", "speedup"))
+    base = None
+    workers = 1
+    while workers <= max_workers:
+        count, cold, warm = measure(workers)
+        if base is None:
+            base = warm
+        print("{:>8} {:>10} {:>12.1f} {:>12.1f} {:>8.2f}".format(workers, count, cold * 1000, warm * 1000, base / warm))
+        workers *= 2
+finally:
+    for s in sleepers:
+        s.kill()
+    for s in sleepers:
+        s.wait()
@@ -0,0 +1,54 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.model import ProcessMetadataCache, ProcessScanner, ProcessSnapshot, ProcessDelta, UserDatabase, read_uptime
+from make_proc_tree import ProcTree
+
+# Times ProcessSnapshot and get_process_lines on synthetic /proc trees made
+# by make_proc_tree.py, cold (empty metadata cache) and warm (after a tick
+# of churn), for every process count given.
+#
+#   python3 test/bench_snapshot.py [processes ...]
+
+ROUNDS = 3
+
+def measure(count):
+    root = tempfile.mkdtemp(prefix="jill-proc-")
+    try:
+        t = time.perf_counter()
+        tree = ProcTree(root, count, 8, 80, 0.01)
+        generate = time.perf_counter() - t
+        scanner = ProcessScanner(ProcessMetadataCache(1000000), 4096, proc_root=tree.proc_root)
+        users = UserDatabase(tree.etc_root)
+        t = time.perf_counter()
+        before = ProcessSnapshot(False, users.current(), read_uptime(tree.proc_root), scanner)
+        cold = time.perf_counter() - t
+        warm = []
+        lines = []
+        for i in range(ROUNDS):
+            tree.tick()
+            t = time.perf_counter()
+            after = ProcessSnapshot(False, users.current(), read_uptime(tree.proc_root), scanner)
+            warm.append(time.perf_counter() - t)
+            delta = ProcessDelta(before, after)
+            t = time.perf_counter()
+            after.get_process_lines(delta)
+            lines.append(time.perf_counter() - t)
+            before = after
+        for proc_files in scanner.proc_files:
+            proc_files.close_all()
+        return len(tree), generate, cold, min(warm), min(lines)
+    finally:
+        shutil.rmtree(root)
+
+counts = [int(a) for a in sys.argv[1:]] or [1000, 10000, 100000]
+print("{:>10} {:>14} {:>14} {:>14} {:>14}".format("processes", "generate [s]", "cold [ms]", "warm [ms]", "lines [ms]"))
+for count in counts:
+    processes, generate, cold, warm, lines = measure(count)
+    print("{:>10} {:>14.1f} {:>14.1f} {:>14.1f} {:>14.1f}".format(processes, generate, cold * 1000, warm * 1000, lines * 1000))
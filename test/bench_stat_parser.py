@@ -0,0 +1,99 @@
+import os
+import statistics
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.model import parse_stat
+
+# Recorded /proc/<pid>/stat lines. Some commands put spaces and parentheses
+# into their comm, the last two are made up to hit the corner cases.
+RECORDED_LINES = [
+    "1 (systemd) S 0 1 1 0 -1 4194560 164502 5306443 126 1672 1193 1311 10853 4186 20 0 1 0 5 175263744 3214 18446744073709551615 1 1 0 0 0 0 671173123 4096 1260 0 0 0 17 2 0 0 0 0 0 0 0 0 0 0 0 0 0",
+    "2 (kthreadd) S 0 0 0 0 -1 2129984 0 0 0 0 0 9 0 0 20 0 1 0 5 0 0 18446744073709551615 0 0 0 0 0 0 0 2147483647 0 0 0 0 2 3 0 0 0 0 0 0 0 0 0 0 0 0 0",
+    "23 (kworker/2:0H-kblockd) I 2 0 0 0 -1 69238880 0 0 0 0 0 0 0 0 0 -20 1 0 6 0 0 18446744073709551615 0 0 0 0 0 0 0 2147483647 0 0 0 0 17 2 0 0 0 0 0 0 0 0 0 0 0 0 0",
+    "1043 (sd-pam) S 1041 1041 1041 0 -1 1077936448 49 0 0 0 0 0 0 0 20 0 1 0 1421 174592000 1268 18446744073709551615 1 1 0 0 0 0 0 4096 0 0 0 0 17 5 0 0 0 0 0 0 0 0 0 0 0 0 0",
+    "1517 (tmux: server) S 1 1517 1517 0 -1 4194368 2863 0 0 0 523 811 0 0 20 0 1 0 4189 11968512 1024 18446744073709551615 1 1 0 0 0 0 0 3674112 134433283 0 0 0 17 0 0 0 0 0 0 0 0 0 0 0 0 0 0",
+    "2931 (Web Content) S 2780 2763 2763 0 -1 4194560 3106221 0 2 0 91374 13302 0 0 20 0 29 0 7840 3221676032 91310 18446744073709551615 1 1 0 0 0 0 0 69638 1082131704 0 0 0 17 1 0 0 0 0 0 0 0 0 0 0 0 0 0",
+    "3120 (Isolated Web Co) S 2780 2763 2763 0 -1 4194560 88102 0 0 0 2601 713 0 0 20 0 26 0 9921 2680442880 47118 18446744073709551615 1 1 0 0 0 0 0 69638 1082131704 0 0 0 17 3 0 0 0 0 0 0 0 0 0 0 0 0 0",
+    "4711 ((sd-pam)) S 4709 4709 4709 0 -1 1077936448 51 0 0 0 0 0 0 0 20 0 1 0 52817 174592000 1270 18446744073709551615 1 1 0 0 0 0 0 4096 0 0 0 0 17 1 0 0 0 0 0 0 0 0 0 0 0 0 0",
+    "5000 (a) b (c) d) R 4999 5000 4999 34816 5000 4194304 120 0 0 0 3 1 0 0 20 0 1 0 60000 2703360 285 18446744073709551615 1 1 0 0 0 0 0 0 0 0 0 0 17 0 0 0 0 0 0 0 0 0 0 0 0 0 0",
+    "5001 (x ( y) S 1 5001 5001 0 -1 4194304 120 0 0 0 3 1 0 0 20 0 1 0 60001 2703360 285 18446744073709551615 1 1 0 0 0 0 0 0 0 0 0 0 17 0 0 0 0 0 0 0 0 0 0 0 0 0 0",
+]
+
+EXPECTED_COMMS = [
+    b"systemd", b"kthreadd", b"kworker/2:0H-kblockd", b"sd-pam", b"tmux: server",
+    b"Web Content", b"Isolated Web Co", b"(sd-pam)", b"a) b (c) d", b"x ( y"
+]
+
+def legacy_split_process_info_line(line):
+    """The parser used by ProcessSnapshot before StatReader/parse_stat"""
+    try:
+        split1 = line.split("(" * line.count("("))
+        before = split1[0][:-1]
+        split2 = split1[1].split(")" * line.count("("))
+        mid = split2[0]
+        after = split2[1][1:]
+        result = before.split(" ") + [mid] + after.split(" ")
+        return result
+    except:
+        raise Exception(line)
+
+def legacy_parse(line):
+    p = legacy_split_process_info_line(line.replace('\n', ''))
+    return (int(p[0]), p[1], ord(p[2]), int(p[3]), int(p[13]), int(p[14]), int(p[15]), int(p[16]), int(p[21]), int(p[22]))
+
+def check_correctness(records):
+    print("Correctness")
+    for (line, buf), expected_comm in zip(records, EXPECTED_COMMS):
+        new = parse_stat(buf, len(line))
+        try:
+            old = legacy_parse(line)
+            old_ok = old[1] == expected_comm.decode() and old[2:] == new[2:]
+        except Exception:
+            old_ok = False
+        new_ok = new[1] == expected_comm
+        print("  {:<24} legacy: {:<5} parse_stat: {}".format(expected_comm.decode(), "ok" if old_ok else "WRONG", "ok" if new_ok else "WRONG"))
+
+def run_benchmark(records, number, repeat):
+    # Only the lines the legacy parser doesn't raise on, to compare like with like
+    parsable = []
+    for line, buf in records:
+        try:
+            legacy_parse(line)
+            parsable.append((line, buf))
+        except Exception:
+            pass
+
+    def bench_legacy():
+        for line, buf in parsable:
+            legacy_parse(line)
+
+    def bench_new():
+        for line, buf in parsable:
+            parse_stat(buf, len(line))
+
+    # Alternating passes, so a slow phase of the machine hits both parsers
+    # alike. The speedup is the median of the per pass ratios.
+    legacy_times = []
+    new_times = []
+    for i in range(repeat):
+        legacy_times.append(timeit.timeit(bench_legacy, number=number))
+        new_times.append(timeit.timeit(bench_new, number=number))
+    ratios = sorted(l / n for l, n in zip(legacy_times, new_times))
+    per_record = 1e9 / (number * len(parsable))
+    print("Benchmark ({} records x {}, {} passes)".format(len(parsable), number, repeat))
+    print("  legacy     : {:8.0f} ns/record (median)".format(statistics.median(legacy_times) * per_record))
+    print("  parse_stat : {:8.0f} ns/record (median)".format(statistics.median(new_times) * per_record))
+    print("  speedup    : {:8.2f}x (median, passes {:.2f}x to {:.2f}x)".format(statistics.median(ratios), ratios[0], ratios[-1]))
+
+def to_buffer(line):
+    data = line.encode() + b"\n"
+    buf = bytearray(4096)
+    buf[:len(data)] = data
+    return buf
+
+records = [(l + "\n", to_buffer(l)) for l in RECORDED_LINES]
+check_correctness(records)
+run_benchmark(records, 5000, 21)
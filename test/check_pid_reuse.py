@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.model import ProcessMetadataCache, ProcessScanner, ProcReader, ProcFilePool
+
+# Kills a process whose /proc/<pid>/stat the pool keeps open and starts a
+# new one on the same pid, then checks the next scan reads the new process
+# instead of dropping it. The pid is reused by writing to
+# /proc/sys/kernel/ns_last_pid, which needs root.
+#
+#   sudo python3 test/check_pid_reuse.py
+
+NS_LAST_PID = "/proc/sys/kernel/ns_last_pid"
+ATTEMPTS = 20
+
+def start_on_pid(pid, args):
+    """A process on pid, None if another one took the pid first"""
+    for i in range(ATTEMPTS):
+        with open(NS_LAST_PID, "w") as f:
+            f.write(str(pid - 1))
+        p = subprocess.Popen(args)
+        if p.pid == pid:
+            return p
+        p.kill()
+        p.wait()
+    return None
+
+def starttime(process_table, pid):
+    row = process_table.find(pid)
+    return process_table.starttime[row] if row >= 0 else None
+
+if not os.access(NS_LAST_PID, os.W_OK):
+    print("Skipped, needs write access to {}".format(NS_LAST_PID))
+    sys.exit(0)
+
+failures = 0
+old = subprocess.Popen(["sleep", "600"])
+pid = old.pid
+scanner = ProcessScanner(ProcessMetadataCache(1000), 4096)
+proc_files = ProcFilePool(16)
+reader = ProcReader(proc_files)
+try:
+    old_starttime = starttime(scanner.scan(1.0), pid)
+    old_stat = reader.read_stat(pid)
+    old.kill()
+    old.wait()
+    # starttime is in clock ticks, the new process must differ
+    time.sleep(0.05)
+    new = start_on_pid(pid, ["sleep", "601"])
+    if new is None:
+        print("Skipped, pid {} was taken by another process".format(pid))
+        sys.exit(0)
+    try:
+        proc_files.start_scan({pid})
+        new_stat = reader.read_stat(pid)
+        ok = new_stat is not None and new_stat[8] != old_stat[8]
+        failures += not ok
+        print("ProcFilePool.readinto after reuse of {}: {}".format(pid, "ok" if ok else "FAILED, new process not read"))
+        new_starttime = starttime(scanner.scan(2.0), pid)
+        ok = new_starttime is not None and new_starttime != old_starttime
+        failures += not ok
+        print("ProcessScanner.scan after reuse of {}:    {}".format(pid, "ok" if ok else "FAILED, new process missing"))
+    finally:
+        new.kill()
+        new.wait()
+finally:
+    proc_files.close_all()
+    for pool in scanner.proc_files:
+        pool.close_all()
+sys.exit(1 if failures else 0)
@@ -0,0 +1,161 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+
+# Writes a made up /proc, /sys and /etc to a directory, to run the model on
+# as many processes as wanted with JillModel(proc_root, sys_root, etc_root)
+# or the proc-root, sys-root and etc-root settings:
+#
+#   python3 test/make_proc_tree.py [--pids N] [--depth N] [--cmdline N] [--ticks N] [--churn F] [DIR]
+#
+# Every further tick starts and ends churn * pids processes, gives CPU time
+# to a tenth of them and moves the uptime on by a second. Benchmarks import
+# ProcTree and call tick() between the scans.
+
+CORES = 4
+USERS = [(0, 'root'), (33, 'www-data'), (999, 'postgres'), (1000, 'alice')]
+COMMS = ["bash", "python3", "postgres", "nginx", "java", "kworker/0:1", "sleep"]
+WORDS = ["--verbose", "-c", "/etc/app.conf", "--queue", "worker", "/srv/data", "-Xmx4g", "--id"]
+
+STAT_FORMAT = ("{pid} ({comm}) {state} {ppid} {pid} {pid} 0 -1 4194560 100 0 0 0 {utime} {stime} 0 0 20 0 1 0 "
+               "{starttime} {vsize} 300 18446744073709551615 1 1 0 0 0 0 0 4096 0 0 0 0 17 0 0 0 0 0 0 0 0 0 0 0 0 0 0\n")
+STATUS_FORMAT = "Name:\t{comm}\nState:\t{state}\nPid:\t{pid}\nPPid:\t{ppid}\nUid:\t{uid}\t{uid}\t{uid}\t{uid}\nVmSwap:\t0 kB\n"
+
+class ProcTree:
+    """Synthetic processes written to root/proc, with root/sys and root/etc
+    next to it. Parents are picked so no branch gets deeper than depth."""
+    def __init__(self, root, pids, depth, cmdline_length, churn, seed=1):
+        self.root = root
+        self.proc_root = os.path.join(root, "proc")
+        self.sys_root = os.path.join(root, "sys")
+        self.etc_root = os.path.join(root, "etc")
+        self.depth = max(2, depth)
+        self.cmdline_length = cmdline_length
+        self.churn = churn
+        self.random = random.Random(seed)
+        self.uptime = 1000.0
+        self.cpu_ticks = 0
+        self.next_pid = 1
+        self.processes = {} # pid -> [ppid, level, uid, comm, utime, stime, starttime]
+        self.children = {} # pid -> set of child pids
+        self._pids = None
+        for d in (self.proc_root, os.path.join(self.sys_root, "class", "thermal"),
+                  os.path.join(self.sys_root, "class", "power_supply"), self.etc_root):
+            os.makedirs(d, exist_ok=True)
+        with open(os.path.join(self.etc_root, "passwd"), "w") as f:
+            for uid, name in USERS:
+                f.write("{}:x:{}:{}::/home/{}:/bin/sh\n".format(name, uid, uid, name))
+        self._start(0)
+        for i in range(pids - 1):
+            self._start(self._pick_parent())
+        self._write_system()
+
+    def __len__(self):
+        return len(self.processes)
+
+    def _pick_parent(self):
+        while True:
+            pid = self.random.choice(self.pids)
+            if self.processes[pid][1] < self.depth:
+                return pid
+
+    @property
+    def pids(self):
+        if self._pids is None:
+            self._pids = list(self.processes)
+        return self._pids
+
+    def _start(self, ppid):
+        pid = self.next_pid
+        self.next_pid += 1
+        level = self.processes[ppid][1] + 1 if ppid else 1
+        uid = self.random.choice(USERS)[0]
+        comm = self.random.choice(COMMS)
+        starttime = int(self.uptime * 100)
+        self.processes[pid] = [ppid, level, uid, comm, 0, 0, starttime]
+        self.children.setdefault(ppid, set()).add(pid)
+        self._pids = None
+        self._write_process(pid, cmdline=True)
+        return pid
+
+    def _end(self, pid):
+        p = self.processes.pop(pid)
+        self.children[p[0]].discard(pid)
+        # Orphans go to init, like in the kernel
+        for child in self.children.pop(pid, ()):
+            self.processes[child][0] = 1
+            self.children[1].add(child)
+            self._write_process(child)
+        self._pids = None
+        shutil.rmtree(os.path.join(self.proc_root, str(pid)))
+
+    def _cmdline(self, comm):
+        words = ["/usr/bin/" + comm.split("/")[0]]
+        length = len(words[0])
+        while length < self.cmdline_length:
+            word = self.random.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return "\0".join(words) + "\0"
+
+    def _write_process(self, pid, cmdline=False):
+        ppid, level, uid, comm, utime, stime, starttime = self.processes[pid]
+        path = os.path.join(self.proc_root, str(pid))
+        os.makedirs(path, exist_ok=True)
+        values = dict(pid=pid, comm=comm, state='S', ppid=ppid, uid=uid, utime=utime, stime=stime,
+                      starttime=starttime, vsize=10000000 + pid)
+        with open(os.path.join(path, "stat"), "w") as f:
+            f.write(STAT_FORMAT.format(**values))
+        with open(os.path.join(path, "status"), "w") as f:
+            f.write(STATUS_FORMAT.format(**values))
+        if cmdline:
+            with open(os.path.join(path, "cmdline"), "w") as f:
+                f.write(self._cmdline(comm))
+
+    def _write_system(self):
+        with open(os.path.join(self.proc_root, "uptime"), "w") as f:
+            f.write("{:.2f} {:.2f}\n".format(self.uptime, self.uptime * CORES * 0.9))
+        with open(os.path.join(self.proc_root, "stat"), "w") as f:
+            t = self.cpu_ticks
+            f.write("cpu  {} 0 {} {} 0 0 0 0 0 0\n".format(t * CORES, t * CORES // 2, t * CORES * 4))
+            for cpu in range(CORES):
+                f.write("cpu{} {} 0 {} {} 0 0 0 0 0 0\n".format(cpu, t, t // 2, t * 4))
+            f.write("btime 1600000000\n")
+        with open(os.path.join(self.proc_root, "meminfo"), "w") as f:
+            f.write("MemTotal:       16000000 kB\nMemFree:         8000000 kB\nMemAvailable:   12000000 kB\n")
+
+    def tick(self):
+        """One second later: processes ended and started, CPU time spent"""
+        self.uptime += 1.0
+        self.cpu_ticks += 100
+        changes = int(len(self.processes) * self.churn)
+        for i in range(changes):
+            pid = self.random.choice(self.pids)
+            if pid > 1:
+                self._end(pid)
+        for i in range(changes):
+            self._start(self._pick_parent())
+        for pid in self.random.sample(self.pids, len(self.processes) // 10):
+            p = self.processes[pid]
+            p[4] += self.random.randrange(1, 20)
+            p[5] += self.random.randrange(0, 5)
+            self._write_process(pid)
+        self._write_system()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pids", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--cmdline", type=int, default=80, help="length of the command lines")
+    parser.add_argument("--ticks", type=int, default=0, help="ticks of churn after the start")
+    parser.add_argument("--churn", type=float, default=0.01, help="share of processes replaced per tick")
+    parser.add_argument("dir", nargs="?")
+    args = parser.parse_args()
+    root = args.dir or tempfile.mkdtemp(prefix="jill-proc-")
+    tree = ProcTree(root, args.pids, args.depth, args.cmdline, args.churn)
+    for i in range(args.ticks):
+        tree.tick()
+    print("{} processes in {}".format(len(tree), root))
+    print('  "proc-root" : "{}", "sys-root" : "{}", "etc-root" : "{}"'.format(tree.proc_root, tree.sys_root, tree.etc_root))